@@ -1,23 +1,132 @@
 # -*- coding: utf-8 -*-
 import inspect
+import time
 
 from django.conf import settings
-from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import User, AnonymousUser
+from django.db import connection
+from django.db.models.signals import post_save, post_delete
 from django.utils.importlib import import_module
 
-from models import RulePermission
-from exceptions import NotBooleanPermission
-from exceptions import NonexistentFieldName
-from exceptions import NonexistentPermission
+from models import is_rule_codename
+from registry import registry
+from evaluators import get_evaluator
+from cache import get_request_cache, get_decision_key, is_memoizable
+from cache import get_shared_cache, get_shared_decision_key
+from instrumentation import get_collector, permission_checked
 from exceptions import RulesError
 
 
+# (ANONYMOUS_USER_ID, User) pair loaded by get_anonymous_user
+_anonymous_user = None
+
+def get_anonymous_user():
+    """
+    Returns the User with pk settings.ANONYMOUS_USER_ID that stands for anonymous
+    users in rules. It is fetched from the database only once per process.
+    If ANONYMOUS_USER_ID is set to None, no User is fetched and None is returned,
+    so rules will receive the AnonymousUser instance itself.
+    """
+    global _anonymous_user
+
+    anonymous_user_id = settings.ANONYMOUS_USER_ID
+    if anonymous_user_id is None:
+        return None
+
+    if _anonymous_user is None or _anonymous_user[0] != anonymous_user_id:
+        _anonymous_user = (anonymous_user_id, User.objects.get(pk=anonymous_user_id))
+    return _anonymous_user[1]
+
+def refresh_anonymous_user():
+    """
+    Forgets the cached anonymous User, call it if you modify that User
+    """
+    global _anonymous_user
+    _anonymous_user = None
+
+def _anonymous_user_changed(sender, instance, **kwargs):
+    # pk could have been set as a string, like ANONYMOUS_USER_ID usually is
+    if _anonymous_user is not None and unicode(_anonymous_user[1].pk) == unicode(instance.pk):
+        refresh_anonymous_user()
+
+post_save.connect(_anonymous_user_changed, sender=User, dispatch_uid='django_rules.backends.anonymous_save')
+post_delete.connect(_anonymous_user_changed, sender=User, dispatch_uid='django_rules.backends.anonymous_delete')
+
+
+class CentralAuthorization(object):
+    """
+    Wraps the central_authorizations function of a module, checking its signature.
+    It counts how many times it is called and the time spent in it.
+    """
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        self.time = 0.0
+
+        try:
+            mod = import_module(module)
+        except ImportError, e:
+            raise RulesError('Error importing central authorizations module %s: "%s"' % (module, e))
+
+        try:
+            self.function = getattr(mod, 'central_authorizations')
+        except AttributeError:
+            raise RulesError('Error module %s does not have a central_authorization function"' % (module))
+
+        try:
+            args, varargs, varkw, defaults = inspect.getargspec(self.function)
+        except TypeError:
+            # It is not a python function, we can't check it
+            return
+
+        if len(args) - len(defaults or ()) > 2 or (len(args) < 2 and varargs is None):
+            raise RulesError('central_authorizations should receive 2 parameters: (user_obj, perm)')
+
+    def __call__(self, user_obj, perm):
+        start = time.time()
+        try:
+            return self.function(user_obj, perm)
+        finally:
+            self.calls += 1
+            self.time += time.time() - start
+
+
+# CentralAuthorization lists resolved for every CENTRAL_AUTHORIZATIONS value
+_central_authorizations = {}
+
+def get_central_authorizations():
+    """
+    Returns the list of CentralAuthorization for settings.CENTRAL_AUTHORIZATIONS,
+    which can be a module or a sequence of modules that are checked in order.
+    Modules are imported and checked only once per process.
+    """
+    modules = getattr(settings, 'CENTRAL_AUTHORIZATIONS', ())
+    if isinstance(modules, basestring):
+        modules = (modules,)
+    modules = tuple(modules)
+
+    try:
+        return _central_authorizations[modules]
+    except KeyError:
+        central_authorizations = [CentralAuthorization(module) for module in modules]
+        _central_authorizations[modules] = central_authorizations
+        return central_authorizations
+
+
 class ObjectPermissionBackend(object):
+    """
+    Django permissions, like 'app_label.codename', are never granted by rules.
+    Methods that are not called through User.has_perm, like has_rule_perm or
+    filter_objects, deny every rule to inactive users and grant every rule to
+    superusers, as Django does.
+    """
     supports_object_permissions = True
     supports_anonymous_user = True
     supports_inactive_user = True
 
+    def __init__(self):
+        self.central_authorizations = get_central_authorizations()
+
     def authenticate(self, username, password):
         return None
 
@@ -28,74 +137,254 @@ class ObjectPermissionBackend(object):
         If it exists returns the value of obj.field_name or obj.field_name() in case
         the field is a method.
         """
-        
-        if obj is None:
+        if obj is None or not is_rule_codename(perm):
             return False
 
-        if not user_obj.is_authenticated():
-            user_obj = User.objects.get(pk=settings.ANONYMOUS_USER_ID)
+        return self._decide(self.get_rule_user(user_obj), perm, obj)
 
-        # Centralized authorizations
-        # You need to define a module in settings.CENTRAL_AUTHORIZATIONS that has a 
-        # central_authorizations function inside
-        if hasattr(settings, 'CENTRAL_AUTHORIZATIONS'):
-            module = getattr(settings, 'CENTRAL_AUTHORIZATIONS')
+    def has_rule_perm(self, user_obj, rule, obj):
+        """
+        Checks rule on obj for user_obj, for callers that have already looked up
+        the rule with the registry
+        """
+        is_authorized = self.check_user_status(user_obj)
+        if is_authorized is not None:
+            return is_authorized
 
-            try:
-                mod = import_module(module)
-            except ImportError, e:
-                raise RulesError('Error importing central authorizations module %s: "%s"' % (module, e))
+        return self._decide(self.get_rule_user(user_obj), rule.codename, obj, rule)
 
-            try:
-                central_authorizations = getattr(mod, 'central_authorizations')
-            except AttributeError:
-                raise RulesError('Error module %s does not have a central_authorization function"' % (module))
-            
-            try:
-                is_authorized = central_authorizations(user_obj, perm)
-                # If the value returned is a boolean we pass it up and stop checking 
-                # If not, we continue checking
-                if isinstance(is_authorized, bool):
-                    return is_authorized
+    def _decide(self, user_obj, perm, obj, rule=None):
+        collector = get_collector()
+        if collector is None and not permission_checked.receivers:
+            return self._lookup(user_obj, perm, obj, rule)[0]
+
+        # Queries are only logged in DEBUG mode
+        queries = None
+        if settings.DEBUG:
+            queries = len(connection.queries)
+        start = time.time()
+        is_authorized, cache_hit = self._lookup(user_obj, perm, obj, rule)
+        duration = time.time() - start
+        if queries is not None:
+            queries = len(connection.queries) - queries
 
-            except TypeError:
-                raise RulesError('central_authorizations should receive 2 parameters: (user_obj, perm)')
+        if collector is not None:
+            collector.record(perm, duration, cache_hit, queries)
+        permission_checked.send(sender=self.__class__, user=user_obj, perm=perm, obj=obj, is_authorized=is_authorized,
+                                duration=duration, cache_hit=cache_hit, queries=queries)
+        return is_authorized
+
+    def _lookup(self, user_obj, perm, obj, rule=None):
+        """
+        Returns the decision and whether it was found in a cache, None if no
+        cache was looked up
+        """
+        # Decisions are memoized while serving a request if RulesCacheMiddleware is enabled
+        decisions = get_request_cache()
+        if decisions is None or not is_memoizable(perm, obj):
+            return self._check(user_obj, perm, obj, rule)
+
+        key = get_decision_key(user_obj, perm, obj)
+        try:
+            return decisions[key], True
+        except KeyError:
+            is_authorized, cache_hit = self._check(user_obj, perm, obj, rule)
+            decisions[key] = is_authorized
+            return is_authorized, cache_hit or False
+
+    def _check(self, user_obj, perm, obj, rule=None):
+        is_authorized = self.check_central_authorizations(user_obj, perm)
+        if is_authorized is not None:
+            return is_authorized, None
 
         # Note:
         # is_active and is_superuser are checked by default in django.contrib.auth.models
         # lines from 301-306 in Django 1.2.3
 	# If this checks dissapear in mainstream, tests will fail, so we won't double check them :)
-        ctype = ContentType.objects.get_for_model(obj)
+        if rule is None:
+            rule = self.get_rule(perm, obj.__class__)
+            if rule is None:
+                return False, None
 
-        # We get the rule data and return the value of that rule
-        try:
-            rule = RulePermission.objects.get(codename = perm, content_type = ctype)
-        except RulePermission.DoesNotExist:
-            return False
+        evaluator = get_evaluator(obj.__class__, rule.field_name)
+        if not rule.cache_timeout or obj.pk is None:
+            return evaluator(obj, user_obj), None
 
-        bound_field = None
-        try:
-            bound_field = getattr(obj, rule.field_name)
-        except AttributeError:
-            raise NonexistentFieldName("Field_name %s from rule %s does not longer exist in model %s. \
-                                        The rule is obsolete!", (rule.field_name, rule.codename, rule.content_type.model))
-
-        if not isinstance(bound_field, bool) and not callable(bound_field):
-            raise NotBooleanPermission("Attribute %s from model %s on rule %s does not return a boolean value",
-                                        (rule.field_name, rule.content_type.model, rule.codename))
-
-        if not callable(bound_field):
-            is_authorized = bound_field
-        else:
-            # Otherwise it is a callabe bound_field
-            # Let's see if we pass or not user_obj as a parameter
-            if (len(inspect.getargspec(bound_field)[0]) == 2):
-                is_authorized = bound_field(user_obj)
-            else:
-                is_authorized = bound_field()
-
-            if not isinstance(is_authorized, bool):
-                raise NotBooleanPermission("Callable %s from model %s on rule %s does not return a boolean value",
-                                            (rule.field_name, rule.content_type.model, rule.codename))
+        # Decisions of expensive rules are kept in the shared cache
+        cache = get_shared_cache()
+        key = get_shared_decision_key(get_decision_key(user_obj, perm, obj), registry.get_rules_version())
+        is_authorized = cache.get(key)
+        if is_authorized is not None:
+            return is_authorized, True
+        is_authorized = evaluator(obj, user_obj)
+        cache.set(key, is_authorized, rule.cache_timeout)
+        return is_authorized, False
 
-        return is_authorized
+    def filter_objects(self, user_obj, perm, objects, mask=False):
+        """
+        Checks perm for user_obj on every object in objects, that can be any iterable
+        or a QuerySet. Returns the list of objects on which user_obj has perm or, if
+        mask is True, a list with True or False for every object.
+
+        Rules are looked up once for every model, so this is much cheaper than calling
+        has_perm for every object.
+        """
+        objects = list(objects)
+        if mask:
+            return self._get_decisions(user_obj, perm, objects)
+        return [obj for obj, is_authorized in zip(objects, self._get_decisions(user_obj, perm, objects))
+                    if is_authorized]
+
+    def get_perms_map(self, user_obj, perms, objects):
+        """
+        Checks every perm in perms for user_obj on every object in objects, that can
+        be any iterable or a QuerySet. Returns a list with a dictionary of decisions
+        by perm for every object, like [{'can_edit': True, 'can_ship': False}, ...].
+
+        Rules are looked up once for every model and objects are iterated once.
+        Rules of the same object sharing a field_name or a composite operand
+        evaluate it only once.
+        """
+        objects = list(objects)
+
+        # Decisions that don't depend on the object
+        fixed = {}
+        for perm in perms:
+            is_authorized = self.check_without_rule(user_obj, perm)[1]
+            if is_authorized is not None:
+                fixed[perm] = is_authorized
+        perms = [perm for perm in perms if perm not in fixed]
+        user_obj = self.get_rule_user(user_obj)
+
+        evaluators = {}
+        perms_map = []
+        for obj in objects:
+            model_class = obj.__class__
+            try:
+                model_evaluators = evaluators[model_class]
+            except KeyError:
+                model_evaluators = evaluators[model_class] = [(perm, self.get_evaluator(perm, model_class))
+                                                                for perm in perms]
+
+            decisions = dict(fixed)
+            memo = {}
+            for perm, evaluator in model_evaluators:
+                decisions[perm] = evaluator is not None and evaluator(obj, user_obj, memo)
+            perms_map.append(decisions)
+        return perms_map
+
+    def annotate_perms(self, user_obj, perms, objects, attname='perms'):
+        """
+        Sets the dictionary of decisions of get_perms_map as the attname attribute
+        of every object in objects. Returns the list of objects.
+        """
+        objects = list(objects)
+        for obj, decisions in zip(objects, self.get_perms_map(user_obj, perms, objects)):
+            setattr(obj, attname, decisions)
+        return objects
+
+    def filter_queryset(self, user_obj, perm, queryset):
+        """
+        Returns queryset filtered to the objects on which user_obj has perm.
+        Only rules on a BooleanField, or on a method or property decorated with
+        django_rules.evaluators.rule_query, can be checked by the database. For
+        other rules RulesError is raised, whoever the user is; use filter_objects.
+        """
+        # The rule is checked first, so the result does not depend on the user
+        evaluator = self.get_evaluator(perm, queryset.model)
+        if evaluator is not None and evaluator.query is None:
+            raise RulesError("Rule %s can't be checked by the database, decorate %s with rule_query "
+                             "or use filter_objects" % (perm, evaluator.field_name))
+
+        user_obj, is_authorized = self.check_without_rule(user_obj, perm)
+        if is_authorized is None and evaluator is not None:
+            return queryset.filter(evaluator.query(user_obj))
+        if is_authorized:
+            return queryset
+        return queryset.none()
+
+    def _get_decisions(self, user_obj, perm, objects):
+        user_obj, is_authorized = self.check_without_rule(user_obj, perm)
+        if is_authorized is not None:
+            return [is_authorized] * len(objects)
+
+        evaluators = {}
+        decisions = []
+        for obj in objects:
+            model_class = obj.__class__
+            try:
+                evaluator = evaluators[model_class]
+            except KeyError:
+                evaluator = evaluators[model_class] = self.get_evaluator(perm, model_class)
+
+            decisions.append(evaluator is not None and evaluator(obj, user_obj))
+        return decisions
+
+    def check_without_rule(self, user_obj, perm):
+        """
+        Returns the user that rules receive and the decision of perm for user_obj
+        that does not depend on any rule: False for Django permissions, the user
+        status or the central authorizations. The decision is None if the rule
+        has to be checked.
+        """
+        rule_user = self.get_rule_user(user_obj)
+        if not is_rule_codename(perm):
+            return rule_user, False
+
+        is_authorized = self.check_user_status(user_obj)
+        if is_authorized is None:
+            is_authorized = self.check_central_authorizations(rule_user, perm)
+        return rule_user, is_authorized
+
+    def check_user_status(self, user_obj):
+        """
+        Returns False for inactive users and True for superusers, as User.has_perm
+        does, None for other users
+        """
+        if user_obj.is_authenticated():
+            if not user_obj.is_active:
+                return False
+            if user_obj.is_superuser:
+                return True
+        return None
+
+    def get_rule_user(self, user_obj):
+        """
+        Returns the user that rules receive, that is the anonymous User for not
+        authenticated users
+        """
+        if not user_obj.is_authenticated():
+            return get_anonymous_user() or user_obj
+        return user_obj
+
+    def check_central_authorizations(self, user_obj, perm):
+        """
+        Returns the first boolean returned by the central authorizations, None if they don't decide
+        """
+        # Centralized authorizations
+        # You need to define a module in settings.CENTRAL_AUTHORIZATIONS that has a 
+        # central_authorizations function inside
+        for central_authorization in self.central_authorizations:
+            is_authorized = central_authorization(user_obj, perm)
+            # If the value returned is a boolean we pass it up and stop checking 
+            # If not, we continue checking
+            if isinstance(is_authorized, bool):
+                return is_authorized
+        return None
+
+    def get_rule(self, perm, model_class):
+        """
+        Returns the rule with codename perm for model_class, None if there is no such rule.
+        Rules of parent and proxied models apply to model_class too.
+        """
+        return registry.get_for_model(perm, model_class)
+
+    def get_evaluator(self, perm, model_class):
+        """
+        Returns the RuleEvaluator of the rule with codename perm for model_class,
+        None if there is no such rule
+        """
+        rule = self.get_rule(perm, model_class)
+        if rule is None:
+            return None
+        return get_evaluator(model_class, rule.field_name)
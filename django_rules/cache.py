@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Caches of permission decisions.
+
+The request cache memoizes decisions while a request is being served. It is
+started and cleared by django_rules.middleware.RulesCacheMiddleware and it is
+kept per thread, as the backend does not have access to the request.
+
+The shared cache keeps decisions of rules that have a cache_timeout in Django's
+cache settings.RULES_CACHE, so they are shared between processes. Its keys carry
+the rules version read when the registry was loaded. The version is bumped
+whenever rules change, so decisions of old rules are never read by processes
+that loaded the new ones.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+
+
+_request_cache = threading.local()
+
+def start_request_cache():
+    _request_cache.decisions = {}
+
+def clear_request_cache():
+    _request_cache.decisions = None
+
+def get_request_cache():
+    """
+    Returns the dictionary of decisions for the current request, None if there is
+    no request cache running
+    """
+    return getattr(_request_cache, 'decisions', None)
+
+
+def is_memoizable(perm, obj):
+    """
+    Unsaved objects and rules listed in settings.RULES_NEVER_MEMOIZE are never memoized
+    """
+    return obj.pk is not None and perm not in getattr(settings, 'RULES_NEVER_MEMOIZE', ())
+
+def get_decision_key(user_obj, perm, obj):
+    """
+    Returns the key of the decision of perm for user_obj on obj
+    """
+    return '%s:%s:%s:%s' % (user_obj.pk, perm, ContentType.objects.get_for_model(obj).id, obj.pk)
+
+
+RULES_VERSION_KEY = 'django_rules:version'
+RULES_VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# Cache instances by alias
+_shared_caches = {}
+
+def get_shared_cache():
+    """
+    Returns the cache set in settings.RULES_CACHE, 'default' if not set
+    """
+    alias = getattr(settings, 'RULES_CACHE', 'default')
+    try:
+        return _shared_caches[alias]
+    except KeyError:
+        cache = _shared_caches[alias] = get_cache(alias)
+        return cache
+
+def get_rules_version():
+    cache = get_shared_cache()
+    version = cache.get(RULES_VERSION_KEY)
+    if version is None:
+        # If the version was evicted we can't start again from a known value
+        # or we could find decisions cached by an old version
+        cache.add(RULES_VERSION_KEY, int(time.time()), RULES_VERSION_TIMEOUT)
+        version = cache.get(RULES_VERSION_KEY)
+    return version
+
+def bump_rules_version(**kwargs):
+    """
+    Changes the rules version, so all decisions in the shared cache are outdated.
+    It can be used as a signal receiver
+    """
+    cache = get_shared_cache()
+    try:
+        cache.incr(RULES_VERSION_KEY)
+    except ValueError:
+        cache.add(RULES_VERSION_KEY, int(time.time()), RULES_VERSION_TIMEOUT)
+
+def get_shared_decision_key(key, version):
+    """
+    Returns the shared cache key for a decision key of a rules version
+    """
+    return 'django_rules:%s:%s' % (version, key)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Composite rules, combinations of other rules of the same model.
+
+A composite is set as a model class attribute and used as the field_name of
+a rule. Its operands are names of attributes, properties, methods or other
+composites of the model:
+
+    class Item(models.Model):
+        ...
+        can_edit = Or('is_supplier', And('is_open', Not('is_locked')))
+
+Composites can also be built with the &, | and ~ operators. They are compiled
+by django_rules.evaluators, which evaluates them with short-circuiting, cheaper
+operands first, and evaluates every operand only once per check.
+"""
+
+
+class Composite(object):
+    def __init__(self, *operands):
+        if not operands:
+            raise ValueError("%s needs at least one operand" % self.__class__.__name__)
+        self.operands = operands
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, ', '.join([repr(operand) for operand in self.operands]))
+
+
+class And(Composite):
+    """
+    True if all operands are True
+    """
+
+
+class Or(Composite):
+    """
+    True if any operand is True
+    """
+
+
+class Not(Composite):
+    """
+    True if its only operand is False
+    """
+    def __init__(self, operand):
+        super(Not, self).__init__(operand)
@@ -8,10 +8,11 @@ from django.http import HttpResponseRedirect
 from django.utils.functional import wraps
 from django.shortcuts import get_object_or_404
 from django.core.urlresolvers import NoReverseMatch, reverse
+from django.db.models.query import QuerySet
 
 from exceptions import RulesError
 from exceptions import NonexistentPermission
-from models import RulePermission
+from registry import registry
 from backends import ObjectPermissionBackend
 
 
@@ -29,13 +30,22 @@ def object_permission_required(perm, **kwargs):
     :param return_403: if set to ``True`` then instead of redirecting to the
       login page, response with status code 403 is returned (
       ``django.http.HttpResponseForbidden`` instance). Defaults to ``False``.
+    :param select_related: fields passed to ``select_related`` when fetching
+      the object, so the rule does not trigger more queries.
+    :param prefetch_related: fields passed to ``prefetch_related`` when fetching
+      the object. Requires Django 1.4.
+    :param only: fields passed to ``only`` when fetching the object. They
+      must include every field used by the rule.
+
+    The object is set as ``request.permission_object``, so the view can use
+    it instead of fetching it again.
 
     Examples::
 
         # RulePermission.objects.get_or_create(codename='can_ship',...,view_param_pk='paramView')
-        @permission_required('can_ship', return_403=True)
+        @permission_required('can_ship', return_403=True, select_related=('supplier',))
         def my_view(request, paramView):
-            return HttpResponse('Hello')
+            return HttpResponse('Hello %s' % request.permission_object.supplier)
 
     """
 
@@ -43,19 +53,25 @@ def object_permission_required(perm, **kwargs):
     redirect_url = kwargs.pop('redirect_url', "")
     redirect_field_name = kwargs.pop('redirect_field_name', REDIRECT_FIELD_NAME)
     return_403 = kwargs.pop('return_403', False)
+    select_related = kwargs.pop('select_related', ())
+    prefetch_related = kwargs.pop('prefetch_related', ())
+    only = kwargs.pop('only', ())
 
     # Check if perm is given as string in order to not decorate
     # view function itself which makes debugging harder
     if not isinstance(perm, basestring):
         raise RulesError("First argument, permission, must be a string")
 
+    if prefetch_related and not hasattr(QuerySet, 'prefetch_related'):
+        raise RulesError("prefetch_related requires Django 1.4 or later")
+
     def decorator(view_func):
         def _wrapped_view(request, *args, **kwargs):
             obj = None
             
-            try:
-                rule = RulePermission.objects.get(codename = perm)
-            except RulePermission.DoesNotExist:
+            # Rules are looked up in the registry, so no queries are made for them
+            rule = registry.get_by_codename(perm)
+            if rule is None:
                 raise NonexistentPermission("Permission %s does not exist" % perm)
 
             # Only look in kwargs, if the views are entry points through urls Django passes parameters as kwargs
@@ -65,10 +81,20 @@ def object_permission_required(perm, **kwargs):
             if rule.view_param_pk not in kwargs: 
                 raise RulesError("The view does not have a parameter called %s in kwargs" % rule.view_param_pk)
                 
-            model_class = rule.content_type.model_class()
-            obj = get_object_or_404(model_class, pk=kwargs[rule.view_param_pk])
+            if rule.model_class is None:
+                raise RulesError("Model of rule %s does not longer exist" % perm)
+            queryset = rule.model_class._default_manager.all()
+            if select_related:
+                queryset = queryset.select_related(*select_related)
+            if prefetch_related:
+                queryset = queryset.prefetch_related(*prefetch_related)
+            if only:
+                queryset = queryset.only(*only)
+            obj = get_object_or_404(queryset, pk=kwargs[rule.view_param_pk])
+            request.permission_object = obj
 
-            if not request.user.has_perm(perm, obj):
+            # The rule is already known, so we ask the backend directly
+            if not ObjectPermissionBackend().has_rule_perm(request.user, rule, obj):
                 if return_403:
                     return HttpResponseForbidden()
                 else:
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Rules are compiled into evaluators that already know how to get the value
+of field_name from an object, so introspection only happens once for every
+(model class, field_name).
+"""
+import inspect
+import time
+
+from django.db import models
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+from exceptions import NonexistentFieldName
+from exceptions import NotBooleanPermission
+from exceptions import RulesError
+from composite import Composite, And, Or, Not
+
+# Kinds of field_name
+ATTRIBUTE = 'attribute'
+METHOD = 'method'
+USER_METHOD = 'user_method'
+COMPOSITE = 'composite'
+
+# Composite operands are reordered by measured cost every REORDER_INTERVAL evaluations
+REORDER_INTERVAL = 100
+
+
+def rule_query(query):
+    """
+    Decorator for methods and properties used as rules. query is a function that
+    receives the user and returns a Q object equivalent to the rule, so the rule
+    can be checked in the database by ObjectPermissionBackend.filter_queryset.
+
+    Example::
+
+        @rule_query(lambda user_obj: Q(supplier=user_obj))
+        def can_ship(self, user_obj):
+            return self.supplier == user_obj
+    """
+    def decorator(function):
+        function.rule_query = query
+        return function
+    return decorator
+
+
+class RuleEvaluator(object):
+    """
+    Returns the boolean value of field_name for an object and a user. Depending
+    on its kind, field_name is read as an attribute or property, called as a
+    method without parameters or called as a method passing the user.
+    query is a function returning the equivalent Q object for a user, or None
+    if the rule can only be checked in python.
+    """
+    __slots__ = ('model_class', 'field_name', 'kind', 'query')
+
+    def __init__(self, model_class, field_name, kind, query=None):
+        self.model_class = model_class
+        self.field_name = field_name
+        self.kind = kind
+        self.query = query
+
+    def __call__(self, obj, user_obj, memo=None):
+        """
+        memo is a dictionary shared by all the evaluators of a check, results
+        are kept there by field_name so composites evaluate every operand once
+        """
+        if memo is not None and self.field_name in memo:
+            return memo[self.field_name]
+
+        try:
+            bound_field = getattr(obj, self.field_name)
+        except AttributeError:
+            raise NonexistentFieldName("Field_name %s does not longer exist in model %s. The rule is obsolete!" %
+                                        (self.field_name, self.model_class._meta.object_name))
+
+        if self.kind == USER_METHOD:
+            is_authorized = bound_field(user_obj)
+        elif self.kind == METHOD:
+            is_authorized = bound_field()
+        else:
+            is_authorized = bound_field
+
+        if not isinstance(is_authorized, bool):
+            raise NotBooleanPermission("%s %s from model %s does not return a boolean value" %
+                                        (self.kind == ATTRIBUTE and 'Attribute' or 'Callable',
+                                         self.field_name, self.model_class._meta.object_name))
+        if memo is not None:
+            memo[self.field_name] = is_authorized
+        return is_authorized
+
+
+class CompositeEvaluator(RuleEvaluator):
+    """
+    Evaluates a Composite field_name, node is the compiled tree of its operands
+    """
+    __slots__ = ('node',)
+
+    def __init__(self, model_class, field_name, node):
+        super(CompositeEvaluator, self).__init__(model_class, field_name, COMPOSITE,
+                                                 node.has_query and node.query or None)
+        self.node = node
+
+    def __call__(self, obj, user_obj, memo=None):
+        if memo is None:
+            memo = {}
+        elif self.field_name in memo:
+            return memo[self.field_name]
+        is_authorized = self.node.evaluate(obj, user_obj, memo)
+        memo[self.field_name] = is_authorized
+        return is_authorized
+
+
+class _Node(object):
+    """
+    Node of a compiled Composite. It measures the time spent evaluating it,
+    so the operands of And and Or can be sorted by cost.
+    """
+    __slots__ = ('calls', 'time')
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+
+    def cost(self):
+        if not self.calls:
+            return 0.0
+        return self.time / self.calls
+
+    def evaluate(self, obj, user_obj, memo):
+        start = time.time()
+        result = self._evaluate(obj, user_obj, memo)
+        self.time += time.time() - start
+        self.calls += 1
+        return result
+
+
+class _Leaf(_Node):
+    __slots__ = ('evaluator', 'has_query')
+
+    def __init__(self, evaluator):
+        super(_Leaf, self).__init__()
+        self.evaluator = evaluator
+        self.has_query = evaluator.query is not None
+
+    def evaluate(self, obj, user_obj, memo):
+        # Results already in memo are free, they don't count in the cost
+        if self.evaluator.field_name in memo:
+            return memo[self.evaluator.field_name]
+        return super(_Leaf, self).evaluate(obj, user_obj, memo)
+
+    def _evaluate(self, obj, user_obj, memo):
+        return self.evaluator(obj, user_obj, memo)
+
+    def query(self, user_obj):
+        return self.evaluator.query(user_obj)
+
+
+class _Not(_Node):
+    __slots__ = ('operand', 'has_query')
+
+    def __init__(self, operand):
+        super(_Not, self).__init__()
+        self.operand = operand
+        self.has_query = operand.has_query
+
+    def _evaluate(self, obj, user_obj, memo):
+        return not self.operand.evaluate(obj, user_obj, memo)
+
+    def query(self, user_obj):
+        return ~self.operand.query(user_obj)
+
+
+class _Group(_Node):
+    """
+    And or Or node. Operands are evaluated cheaper first until the result is known
+    """
+    __slots__ = ('operands', 'has_query')
+
+    # Result of the group when an operand returns it
+    short_circuit = None
+
+    def __init__(self, operands):
+        super(_Group, self).__init__()
+        self.operands = operands
+        self.has_query = all(operand.has_query for operand in operands)
+
+    def _evaluate(self, obj, user_obj, memo):
+        # A new sorted list is assigned, other threads may be iterating the old one
+        if self.calls and not self.calls % REORDER_INTERVAL:
+            self.operands = sorted(self.operands, key=lambda operand: operand.cost())
+
+        for operand in self.operands:
+            if operand.evaluate(obj, user_obj, memo) == self.short_circuit:
+                return self.short_circuit
+        return not self.short_circuit
+
+
+class _And(_Group):
+    __slots__ = ()
+    short_circuit = False
+
+    def query(self, user_obj):
+        return reduce(lambda q1, q2: q1 & q2, [operand.query(user_obj) for operand in self.operands])
+
+
+class _Or(_Group):
+    __slots__ = ()
+    short_circuit = True
+
+    def query(self, user_obj):
+        return reduce(lambda q1, q2: q1 | q2, [operand.query(user_obj) for operand in self.operands])
+
+
+def compile_evaluator(model_class, field_name):
+    """
+    Returns a RuleEvaluator for field_name in model_class. Raises NonexistentFieldName
+    if field_name does not exist and RulesError if it is a method with too many parameters
+    """
+    # First search for a method or property defined in the model class
+    # Then we look in the meta field_names
+    if not hasattr(model_class, field_name):
+        if not (field_name in model_class._meta.get_all_field_names()):
+            raise NonexistentFieldName("field_name %s does not exist in model %s" %
+                                        (field_name, model_class._meta.object_name))
+        return RuleEvaluator(model_class, field_name, ATTRIBUTE, _get_field_query(model_class, field_name))
+
+    bound_field = getattr(model_class, field_name)
+    if isinstance(bound_field, Composite):
+        return _compile_composite(model_class, field_name, bound_field)
+    if isinstance(bound_field, property):
+        return RuleEvaluator(model_class, field_name, ATTRIBUTE, getattr(bound_field.fget, 'rule_query', None))
+    if not callable(bound_field):
+        return RuleEvaluator(model_class, field_name, ATTRIBUTE, _get_field_query(model_class, field_name))
+
+    # Methods can receive the user or nothing, self is included in the count
+    number_parameters = len(inspect.getargspec(bound_field)[0])
+    if number_parameters > 2:
+        raise RulesError("method %s in model %s has too many parameters." %
+                            (field_name, model_class._meta.object_name))
+
+    query = getattr(bound_field, 'rule_query', None)
+    if number_parameters == 2:
+        return RuleEvaluator(model_class, field_name, USER_METHOD, query)
+    return RuleEvaluator(model_class, field_name, METHOD, query)
+
+
+# Composites being compiled, to detect the ones that reference themselves
+_compiling = set()
+
+def _compile_composite(model_class, field_name, composite):
+    if (model_class, field_name) in _compiling:
+        raise RulesError("composite %s in model %s references itself" %
+                            (field_name, model_class._meta.object_name))
+    _compiling.add((model_class, field_name))
+    try:
+        return CompositeEvaluator(model_class, field_name, _compile_node(model_class, composite))
+    finally:
+        _compiling.discard((model_class, field_name))
+
+def _compile_node(model_class, operand):
+    if isinstance(operand, basestring):
+        return _Leaf(get_evaluator(model_class, operand))
+    if isinstance(operand, Not):
+        return _Not(_compile_node(model_class, operand.operands[0]))
+    if isinstance(operand, And):
+        return _And([_compile_node(model_class, child) for child in operand.operands])
+    if isinstance(operand, Or):
+        return _Or([_compile_node(model_class, child) for child in operand.operands])
+    raise RulesError("invalid operand %r in composite of model %s" % (operand, model_class._meta.object_name))
+
+
+def _boolean_field_query(field_name):
+    def query(user_obj):
+        return Q(**{field_name: True})
+    return query
+
+
+def _get_field_query(model_class, field_name):
+    """
+    Returns the query function for a BooleanField, None for any other attribute
+    """
+    try:
+        field = model_class._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return None
+    if isinstance(field, models.BooleanField):
+        return _boolean_field_query(field_name)
+    return None
+
+
+# Compiled RuleEvaluators by (model_class, field_name)
+_evaluators = {}
+
+def get_evaluator(model_class, field_name):
+    """
+    Returns the RuleEvaluator for field_name in model_class, compiling it only once
+    """
+    try:
+        return _evaluators[(model_class, field_name)]
+    except KeyError:
+        evaluator = compile_evaluator(model_class, field_name)
+        _evaluators[(model_class, field_name)] = evaluator
+        return evaluator
+
+def clear_evaluators():
+    """
+    Forgets all compiled RuleEvaluators, call it if you change model classes at runtime
+    """
+    _evaluators.clear()
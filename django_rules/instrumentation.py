@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of permission checks.
+
+If settings.RULES_COLLECTOR is set to the path of a collector class, every check
+done by ObjectPermissionBackend.has_perm or has_rule_perm is recorded by codename:
+number of checks, cache hits and misses, database queries (only if settings.DEBUG
+is True) and a histogram of latencies. The permission_checked signal is sent for
+every check if it has receivers. With no collector and no receivers, checks are
+not measured at all.
+
+MemoryCollector keeps the stats of its own process. CacheCollector keeps them in
+the cache settings.RULES_CACHE, so the rules_stats command can show the stats of
+all processes.
+"""
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+from cache import get_shared_cache, RULES_VERSION_TIMEOUT
+from exceptions import RulesError
+
+
+permission_checked = Signal(providing_args=['user', 'perm', 'obj', 'is_authorized', 'duration', 'cache_hit', 'queries'])
+
+# Upper bounds in milliseconds of the latency histogram buckets, there is one more
+# bucket for slower checks
+HISTOGRAM_BUCKETS = (0.1, 0.5, 1, 5, 10, 50, 100, 500)
+
+
+def get_bucket(duration):
+    """
+    Returns the index of the histogram bucket of a duration in seconds
+    """
+    return bisect_left(HISTOGRAM_BUCKETS, duration * 1000)
+
+def new_stats():
+    return {'checks': 0, 'hits': 0, 'misses': 0, 'queries': 0, 'time': 0.0,
+            'histogram': [0] * (len(HISTOGRAM_BUCKETS) + 1)}
+
+
+class BaseCollector(object):
+    """
+    Interface of the collectors of settings.RULES_COLLECTOR
+    """
+    def record(self, perm, duration, cache_hit, queries):
+        """
+        Records a check of perm that took duration seconds. cache_hit is True
+        or False if a cache was looked up, None otherwise. queries is None if
+        they were not counted.
+        """
+        raise NotImplementedError
+
+    def get_stats(self):
+        """
+        Returns a dictionary of stats, as returned by new_stats, by codename
+        """
+        raise NotImplementedError
+
+    def reset(self):
+        raise NotImplementedError
+
+
+class MemoryCollector(BaseCollector):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, perm, duration, cache_hit, queries):
+        self._lock.acquire()
+        try:
+            try:
+                stats = self._stats[perm]
+            except KeyError:
+                stats = self._stats[perm] = new_stats()
+            stats['checks'] += 1
+            if cache_hit is not None:
+                stats[cache_hit and 'hits' or 'misses'] += 1
+            stats['queries'] += queries or 0
+            stats['time'] += duration
+            stats['histogram'][get_bucket(duration)] += 1
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            return dict((perm, dict(stats, histogram=list(stats['histogram'])))
+                            for perm, stats in self._stats.items())
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._stats = {}
+        finally:
+            self._lock.release()
+
+
+STATS_CODENAMES_KEY = 'django_rules:stats:codenames'
+
+class CacheCollector(BaseCollector):
+    """
+    Keeps the stats in the shared cache as counters. Times are kept in microseconds.
+    """
+    def _key(self, perm, counter):
+        return 'django_rules:stats:%s:%s' % (perm, counter)
+
+    def _incr(self, cache, perm, counter, delta=1):
+        key = self._key(perm, counter)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            if cache.add(key, delta, RULES_VERSION_TIMEOUT):
+                if counter == 'checks':
+                    codenames = cache.get(STATS_CODENAMES_KEY) or []
+                    cache.set(STATS_CODENAMES_KEY, codenames + [perm], RULES_VERSION_TIMEOUT)
+            else:
+                cache.incr(key, delta)
+
+    def record(self, perm, duration, cache_hit, queries):
+        cache = get_shared_cache()
+        self._incr(cache, perm, 'checks')
+        if cache_hit is not None:
+            self._incr(cache, perm, cache_hit and 'hits' or 'misses')
+        if queries:
+            self._incr(cache, perm, 'queries', queries)
+        self._incr(cache, perm, 'time', int(duration * 1000000))
+        self._incr(cache, perm, 'bucket%s' % get_bucket(duration))
+
+    def get_stats(self):
+        cache = get_shared_cache()
+        result = {}
+        for perm in set(cache.get(STATS_CODENAMES_KEY) or []):
+            stats = new_stats()
+            buckets = ['bucket%s' % index for index in range(len(stats['histogram']))]
+            counters = cache.get_many([self._key(perm, counter) for counter in
+                                        ['checks', 'hits', 'misses', 'queries', 'time'] + buckets])
+            for counter in ('checks', 'hits', 'misses', 'queries'):
+                stats[counter] = counters.get(self._key(perm, counter), 0)
+            stats['time'] = counters.get(self._key(perm, 'time'), 0) / 1000000.0
+            stats['histogram'] = [counters.get(self._key(perm, bucket), 0) for bucket in buckets]
+            result[perm] = stats
+        return result
+
+    def reset(self):
+        cache = get_shared_cache()
+        keys = [STATS_CODENAMES_KEY]
+        for perm in cache.get(STATS_CODENAMES_KEY) or []:
+            keys.extend([self._key(perm, counter) for counter in ('checks', 'hits', 'misses', 'queries', 'time')])
+            keys.extend([self._key(perm, 'bucket%s' % index) for index in range(len(HISTOGRAM_BUCKETS) + 1)])
+        cache.delete_many(keys)
+
+
+# Collector instances by RULES_COLLECTOR value
+_collectors = {}
+
+def get_collector():
+    """
+    Returns the collector of settings.RULES_COLLECTOR, None if it is not set.
+    The collector class is imported and instantiated only once per process.
+    """
+    path = getattr(settings, 'RULES_COLLECTOR', None)
+    if path is None:
+        return None
+
+    try:
+        return _collectors[path]
+    except KeyError:
+        try:
+            module, attr = path.rsplit('.', 1)
+            collector_class = getattr(import_module(module), attr)
+        except (ValueError, ImportError, AttributeError), e:
+            raise RulesError('Error importing rules collector %s: "%s"' % (path, e))
+        collector = _collectors[path] = collector_class()
+        return collector
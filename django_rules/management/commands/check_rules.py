@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from django_rules.backends import get_central_authorizations
+from django_rules.exceptions import RulesError
+from django_rules.registry import registry
+
+
+class Command(NoArgsCommand):
+    help = 'Loads and validates all rules and central authorizations, failing if any rule is obsolete'
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+
+        start = time.time()
+        try:
+            get_central_authorizations()
+            count = registry.warm_up()
+        except RulesError, e:
+            raise CommandError(str(e))
+
+        if verbosity >= 1:
+            sys.stderr.write('%s rules are valid (%.1f ms)\n' % (count, (time.time() - start) * 1000))
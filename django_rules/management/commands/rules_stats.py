@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from django_rules.instrumentation import get_collector, HISTOGRAM_BUCKETS
+from django_rules.exceptions import RulesError
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option("--reset", action='store_true', dest="reset", default=False,
+                   help="Reset the stats after showing them"),
+    )
+    help = 'Shows the stats of permission checks by rule, slowest rules first'
+
+    def handle_noargs(self, **options):
+        try:
+            collector = get_collector()
+        except RulesError, e:
+            raise CommandError(str(e))
+        if collector is None:
+            raise CommandError("settings.RULES_COLLECTOR is not set, permission checks are not being recorded")
+
+        stats = collector.get_stats()
+        sys.stdout.write(format_stats(stats))
+        if options.get('reset'):
+            collector.reset()
+
+
+def format_stats(stats):
+    """
+    Returns stats, as returned by a collector, as a table sorted by total time
+    """
+    buckets = ['<%sms' % bound for bound in HISTOGRAM_BUCKETS] + ['>%sms' % HISTOGRAM_BUCKETS[-1]]
+    lines = ['%-30s %8s %8s %8s %8s %10s %8s  %s' % ('codename', 'checks', 'hits', 'misses', 'queries',
+                                                     'total ms', 'avg ms', ' '.join(buckets))]
+    for perm, perm_stats in sorted(stats.items(), key=lambda item: -item[1]['time']):
+        lines.append('%-30s %8s %8s %8s %8s %10.1f %8.3f  %s' % (perm, perm_stats['checks'], perm_stats['hits'],
+                        perm_stats['misses'], perm_stats['queries'], perm_stats['time'] * 1000,
+                        perm_stats['checks'] and perm_stats['time'] * 1000 / perm_stats['checks'],
+                        ' '.join(['%*s' % (len(bucket), count) for bucket, count in zip(buckets, perm_stats['histogram'])])))
+    return '\n'.join(lines) + '\n'
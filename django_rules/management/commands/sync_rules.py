@@ -1,46 +1,91 @@
 # -*- coding: utf-8 -*-
 import sys, os
 import imp
+import time
 from optparse import make_option
 
 from django.conf import settings
 from django.utils.importlib import import_module
 from django.core.management import call_command
-from django.core.management import BaseCommand
-from django.db import connections
+from django.core.management import BaseCommand, CommandError
+from django.db import router
 
+from django_rules import utils
+from django_rules.manifest import dump_manifest, register_manifest
+from django_rules.models import RulePermission
+from django_rules.exceptions import RulesError
 
-def import_app(app_label, verbosity):
+
+def find_rules_module(app_label):
+    """
+    Returns the name of the rules module of the app, None if it doesn't have one.
+    The rules module is not imported.
+    """
     # We get the app_path, necessary to use imp module find function
     try:
         app_path = __import__(app_label, {}, {}, [app_label.split('.')[-1]]).__path__
     except AttributeError:
-        return
+        return None
     except ImportError:
         print "Unknown application: %s" % app_label
         print "Stopping synchronization"
         sys.exit(1)
-   
+
     # imp.find_module looks for rules.py within the app
     # It does not import the module, but raises and ImportError
     # if rules.py does not exist, so we continue to next app
     try:
         imp.find_module('rules', app_path)
     except ImportError:
-        return
+        return None
+
+    return '%s.rules' % app_label
+
+
+def discover_rules(app_labels, verbosity):
+    """
+    Finds the rules modules of the apps and imports them, so their rules are
+    registered. The database is not touched. Errors in the rules of every app
+    are collected and raised together as a CommandError.
+    """
+    modules = [(app_label, find_rules_module(app_label)) for app_label in app_labels]
+
+    errors = []
+    for app_label, module in modules:
+        if module is None:
+            continue
+
+        start = time.time()
+        # Now we import the module, this should bubble up errors
+        # if there are any in rules.py Warning the user
+        try:
+            import_module(module)
+        except RulesError, e:
+            errors.append('%s: %s' % (app_label, e))
+            continue
 
-    if verbosity >= 1:
-        sys.stderr.write('Syncing rules from %s\n' % app_label)
-    
-    # Now we import the module, this should bubble up errors
-    # if there are any in rules.py Warning the user
-    generator = import_module('.rules', app_label)
+        if verbosity >= 1:
+            sys.stderr.write('Syncing rules from %s (%.1f ms)\n' % (app_label, (time.time() - start) * 1000))
+
+    if errors:
+        raise CommandError("Invalid rules, nothing was synced:\n%s" % '\n'.join(errors))
 
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
         make_option("--fixture", action='store_true', dest="fixture", default=False,
                    help="Generate a fixture of django_rules"),
+        make_option("--prune", action='store_true', dest="prune", default=False,
+                   help="Delete rules that are not registered in any rules.py"),
+        make_option("--manifest", dest="manifest", default=None,
+                   help="Write a manifest of the synced rules into this file, - for stdout"),
+        make_option("--from-manifest", dest="from_manifest", default=None,
+                   help="Sync the rules of this manifest instead of those in rules.py files"),
+        make_option("--database", dest="database", default=None,
+                   help="Database to sync the rules into, the one chosen by the routers by default"),
+        make_option("--propagate", dest="propagate", default=None,
+                   help="Comma separated databases to sync the rules into after --database, "
+                        "settings.RULES_PROPAGATE_DATABASES by default"),
     )
     help = 'Syncs into database all rules defined in rules.py files'
     args = '[appname ...]'
@@ -48,18 +93,60 @@ class Command(BaseCommand):
     def handle(self, *app_labels, **options):
         verbosity = int(options.pop('verbosity', 1))
         fixture = options.pop('fixture')
+        prune = options.pop('prune')
+        manifest = options.pop('manifest', None)
+        from_manifest = options.pop('from_manifest', None)
+        database = options.pop('database', None) or router.db_for_write(RulePermission)
+        propagate = options.pop('propagate', None)
+        if propagate is None:
+            propagate = getattr(settings, 'RULES_PROPAGATE_DATABASES', ())
+        elif isinstance(propagate, basestring):
+            propagate = [alias.strip() for alias in propagate.split(',') if alias.strip()]
+        propagate = [alias for alias in propagate if alias != database]
+
+        if prune and app_labels:
+            raise CommandError("--prune needs to sync the rules of all applications")
+        if from_manifest and app_labels:
+            raise CommandError("--from-manifest can't be used with applications")
 
-        if len(app_labels) == 0:
+        start = time.time()
+        if from_manifest:
+            stream = open(from_manifest)
+            try:
+                count = register_manifest(stream)
+            except RulesError, e:
+                raise CommandError("Invalid rules manifest %s: %s" % (from_manifest, e))
+            finally:
+                stream.close()
+            if verbosity >= 1:
+                sys.stderr.write('Syncing %s rules from %s\n' % (count, from_manifest))
+        else:
             # We look for a rules.py within every app in INSTALLED_APPS
             # We sync the rules_list against RulePermissions
-            for app_label in settings.INSTALLED_APPS:
-                import_app(app_label, verbosity)
-        else:
-            for app_label in app_labels:
-                import_app(app_label, verbosity)
+            discover_rules(app_labels or settings.INSTALLED_APPS, verbosity)
+
+        # The rules are written into database first, then copied to the others
+        for alias in [database] + list(propagate):
+            created, updated, deleted = utils.sync(prune=prune, using=alias)
+            if verbosity >= 1:
+                if created or updated or deleted:
+                    sys.stderr.write('%s rules created, %s updated, %s deleted in database %s (%.1f ms)\n' %
+                                        (len(created), len(updated), len(deleted), alias, (time.time() - start) * 1000))
+                else:
+                    sys.stderr.write('No rules changed in database %s (%.1f ms)\n' % (alias, (time.time() - start) * 1000))
+
+        if manifest == '-':
+            dump_manifest(sys.stdout, using=database)
+        elif manifest:
+            stream = open(manifest, 'w')
+            try:
+                count = dump_manifest(stream, using=database)
+            finally:
+                stream.close()
+            if verbosity >= 1:
+                sys.stderr.write('%s rules written to manifest %s\n' % (count, manifest))
 
         if fixture:
-            for alias in connections._connections:
-                call_command("dumpdata",
+            call_command("dumpdata",
                          'django_rules.rulepermission',
-                        **dict(options, verbosity=0, database=alias))
+                        **dict(options, verbosity=0, database=database))
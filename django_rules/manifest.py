@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Rules manifests, a compact format to export and import rules without dumpdata.
+
+A manifest is a JSON lines file. The first line is a header with the format
+version and every other line is a rule:
+
+    {"format": "django-rules", "version": 1}
+    {"codename": "can_ship", "app_label": "shipping", "model": "item", "field_name": "can_ship", ...}
+
+Manifests are written and read one line at a time, so they can be streamed.
+"""
+from django.utils import simplejson
+
+from exceptions import RulesError
+from models import RulePermission
+
+MANIFEST_FORMAT = 'django-rules'
+MANIFEST_VERSION = 1
+
+# Keys of every rule in a manifest
+MANIFEST_FIELDS = ('codename', 'app_label', 'model', 'field_name', 'view_param_pk',
+                   'description', 'cache_timeout', 'fingerprint')
+
+
+def dump_manifest(stream, rules=None, using=None):
+    """
+    Writes a manifest of rules, all RulePermissions in the database using if not
+    given, into stream. Returns the number of rules written
+    """
+    if rules is None:
+        rules = RulePermission.objects.using(using).select_related('content_type').order_by('codename').iterator()
+
+    stream.write(simplejson.dumps({'format': MANIFEST_FORMAT, 'version': MANIFEST_VERSION}) + '\n')
+    count = 0
+    for rule in rules:
+        stream.write(simplejson.dumps({
+            'codename': rule.codename,
+            'app_label': rule.content_type.app_label,
+            'model': rule.content_type.model,
+            'field_name': rule.field_name,
+            'view_param_pk': rule.view_param_pk,
+            'description': rule.description,
+            'cache_timeout': rule.cache_timeout,
+            'fingerprint': rule.fingerprint,
+        }) + '\n')
+        count += 1
+    return count
+
+
+def read_manifest(stream):
+    """
+    Yields every rule in a manifest as a dictionary with MANIFEST_FIELDS keys.
+    Raises RulesError if stream is not a manifest of a supported version
+    """
+    try:
+        header = simplejson.loads(stream.readline())
+    except ValueError:
+        raise RulesError("Rules manifest does not have a valid header")
+    if not isinstance(header, dict) or header.get('format') != MANIFEST_FORMAT:
+        raise RulesError("Rules manifest does not have a valid header")
+    if header.get('version') != MANIFEST_VERSION:
+        raise RulesError("Rules manifest version %s is not supported" % header.get('version'))
+
+    for number, line in enumerate(stream):
+        if not line.strip():
+            continue
+        try:
+            rule = simplejson.loads(line)
+            yield dict((field, rule[field]) for field in MANIFEST_FIELDS)
+        except (ValueError, KeyError, TypeError):
+            raise RulesError("Invalid rule in line %s of rules manifest" % (number + 2))
+
+
+def register_manifest(stream):
+    """
+    Registers every rule in a manifest, so they are written by utils.sync
+    """
+    # utils imports the registry, that imports this module
+    from utils import register
+
+    count = 0
+    for rule in read_manifest(stream):
+        register(app_name=rule['app_label'], codename=rule['codename'], model=rule['model'],
+                 field_name=rule['field_name'], view_param_pk=rule['view_param_pk'],
+                 description=rule['description'] or '', cache_timeout=rule['cache_timeout'])
+        count += 1
+    return count
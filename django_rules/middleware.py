@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from cache import start_request_cache
+from cache import clear_request_cache
+
+
+class RulesCacheMiddleware(object):
+    """
+    Memoizes the decisions of ObjectPermissionBackend.has_perm while serving a
+    request, so asking the same (user, perm, obj) question again is free.
+    Decisions are forgotten when the response is returned.
+    """
+    def process_request(self, request):
+        start_request_cache()
+
+    def process_response(self, request, response):
+        clear_request_cache()
+        return response
@@ -1,11 +1,67 @@
 # -*- coding: utf-8 -*-
-import inspect
+import hashlib
+
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.contrib.contenttypes.models import ContentType
 
 from exceptions import NonexistentFieldName
 from exceptions import RulesError
+from evaluators import get_evaluator
+from cache import bump_rules_version
+
+
+def get_fingerprint(codename, app_label, model, field_name, view_param_pk, description, cache_timeout):
+    """
+    Returns a hash of the rule definition, so sync_rules can tell if a rule changed
+    """
+    values = (codename, app_label, model, field_name, view_param_pk, description or '', cache_timeout)
+    return hashlib.md5(u'\x00'.join([unicode(value) for value in values]).encode('utf-8')).hexdigest()
+
+
+def is_rule_codename(perm):
+    """
+    Dotted perms, like 'app_label.codename', are Django permissions and never
+    the codename of a rule
+    """
+    return '.' not in perm
+
+def validate_rule(codename, field_name, model_class):
+    """
+    Raises NonexistentFieldName if field_name does not exist in model_class and
+    RulesError if it is a method with too many parameters or an invalid composite,
+    or if codename is dotted. The rule is compiled here, so checks don't need to
+    introspect the model again
+    """
+    if not is_rule_codename(codename):
+        raise RulesError("Could not create rule %s: codenames of rules can't contain dots" % codename)
+
+    try:
+        get_evaluator(model_class, field_name)
+    except NonexistentFieldName:
+        raise NonexistentFieldName("Could not create rule: field_name %s of rule %s does not exist in model %s" %
+                                    (field_name, codename, model_class._meta.object_name))
+    except RulesError, e:
+        raise RulesError("Could not create rule %s: %s" % (codename, e))
+
+
+class RulePermissionManager(models.Manager):
+    def queryset_for(self, user_obj, perm, queryset):
+        """
+        Returns queryset filtered to the objects on which user_obj has perm, see
+        ObjectPermissionBackend.filter_queryset
+        """
+        from backends import ObjectPermissionBackend
+        return ObjectPermissionBackend().filter_queryset(user_obj, perm, queryset)
+
+    def annotate_for(self, user_obj, perms, queryset, attname='perms'):
+        """
+        Returns the list of objects of queryset, each with a dictionary of decisions
+        for user_obj by perm as its attname attribute, see ObjectPermissionBackend.annotate_perms
+        """
+        from backends import ObjectPermissionBackend
+        return ObjectPermissionBackend().annotate_perms(user_obj, perms, queryset, attname)
 
 
 class RulePermission(models.Model):
@@ -17,6 +73,12 @@ class RulePermission(models.Model):
     content_type = models.ForeignKey(ContentType)
     view_param_pk = models.CharField(max_length=30)
     description = models.CharField(max_length=140, null=True)
+    # Seconds that decisions of this rule are kept in the shared cache, None to not cache them
+    cache_timeout = models.PositiveIntegerField(null=True, blank=True)
+    # Hash of the fields above, see get_fingerprint
+    fingerprint = models.CharField(max_length=32, blank=True, default='')
+
+    objects = RulePermissionManager()
 
 
     def save(self, *args, **kwargs):
@@ -34,18 +96,15 @@ class RulePermission(models.Model):
 
         # First search for a method or property defined in the model class
         # Then we look in the meta field_names
-        # If field_name does not exist a ValidationError is raised
-        if not hasattr(self.content_type.model_class(), self.field_name):
-            # Search within attributes field names
-            if not (self.field_name in self.content_type.model_class()._meta.get_all_field_names()):
-                raise NonexistentFieldName("Could not create rule: field_name %s of rule %s does not exist in model %s" %
-                                            (self.field_name, self.codename, self.content_type.model))
-        else:
-            # Check if the method parameters are less than 2 including self in the count
-            bound_field = getattr(self.content_type.model_class(), self.field_name)
-            if callable(bound_field):
-                if len(inspect.getargspec(bound_field)[0]) > 2:
-                    raise RulesError("method %s from rule %s in model %s has too many parameters." %
-                                        (self.field_name, self.codename, self.content_type.model))
-        
+        # If field_name does not exist a NonexistentFieldName is raised
+        validate_rule(self.codename, self.field_name, self.content_type.model_class())
+
+        self.fingerprint = get_fingerprint(self.codename, self.content_type.app_label, self.content_type.model,
+                                            self.field_name, self.view_param_pk, self.description, self.cache_timeout)
+
         super(RulePermission, self).save(*args, **kwargs)
+
+
+# Connected here, so processes that change rules without checking them bump the version too
+post_save.connect(bump_rules_version, sender=RulePermission, dispatch_uid='django_rules.models.save')
+post_delete.connect(bump_rules_version, sender=RulePermission, dispatch_uid='django_rules.models.delete')
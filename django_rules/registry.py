@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Process-local registry of rules.
+
+All rules are loaded from the database the first time they are needed and
+kept in memory as RuleRecords, keyed by codename and by the model classes they
+apply to, so permission checks don't pay a database round trip. The registry is emptied whenever a rule is
+saved or deleted and when sync_rules is run, it will be reloaded on next use.
+As those signals are sent before the transaction is committed, rules loaded
+by other threads while that transaction may be open are not kept.
+
+Rules also apply to the models that inherit from the model of the rule, with
+multi-table inheritance or as proxies. The rules that apply to every model class
+are resolved through its MRO the first time it is checked.
+
+The rules version of the shared cache is read before loading the rules, so
+decisions are cached under the version of the rules that made them.
+
+Rules are read from the database settings.RULES_DATABASE, for example a
+replica, or from the one that the routers choose if it is not set. If
+settings.RULES_MANIFEST is set to the path of a rules manifest, rules are
+loaded from that file instead of a database.
+"""
+import thread
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_model
+from django.db.models.signals import post_save, post_delete
+
+from models import RulePermission, validate_rule
+from manifest import read_manifest
+from cache import get_rules_version
+from exceptions import RulesError
+
+
+# Seconds after which uncommitted rule changes are assumed to be committed or rolled
+# back, if the thread that made them has not checked a rule since
+PENDING_TIMEOUT = 30
+
+
+class RuleRecord(namedtuple('RuleRecord', 'codename field_name model_class view_param_pk cache_timeout')):
+    """
+    Immutable copy of the RulePermission fields needed to check a rule. Unlike
+    model instances, it doesn't keep any state and its model class is already
+    resolved. model_class is None if the model of the rule does not exist anymore.
+    Evaluators are looked up for the class of the checked object, which can be a
+    subclass of model_class, so they are not kept here.
+    """
+    __slots__ = ()
+
+
+class RuleRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (codenames, models, rules version) of the loaded rules, replaced as a whole
+        self._snapshot = None
+        # Bumped by every invalidation, so loads that overlap one are not kept
+        self._generation = 0
+        # Expiry times of the rule changes that may not be committed yet, by
+        # (thread ident, database alias) of the transaction that made them
+        self._pending = {}
+
+    def _get_rules(self):
+        manifest = getattr(settings, 'RULES_MANIFEST', None)
+        using = getattr(settings, 'RULES_DATABASE', None)
+        if manifest is None:
+            # Models are resolved from the app registry, get_model returns None for removed ones
+            return [RuleRecord(codename, field_name, get_model(app_label, model), view_param_pk, cache_timeout)
+                    for codename, field_name, app_label, model, view_param_pk, cache_timeout in
+                        RulePermission.objects.using(using).values_list('codename', 'field_name', 'content_type__app_label',
+                                                                        'content_type__model', 'view_param_pk', 'cache_timeout')]
+        return self._read_manifest(manifest)
+
+    def _read_manifest(self, path):
+        rules = []
+        stream = open(path)
+        try:
+            for definition in read_manifest(stream):
+                model_class = get_model(definition['app_label'], definition['model'])
+                if model_class is None:
+                    raise RulesError("Model %s of rule %s in rules manifest was not found for app %s" %
+                                        (definition['model'], definition['codename'], definition['app_label']))
+                rules.append(RuleRecord(definition['codename'], definition['field_name'], model_class,
+                                        definition['view_param_pk'], definition['cache_timeout']))
+        finally:
+            stream.close()
+        return rules
+
+    def _load(self):
+        """
+        Loads all rules and returns them as a (codenames, models, version) snapshot. The
+        snapshot is kept only if the registry was not invalidated while loading
+        and no other thread has uncommitted rule changes, so outdated rules are
+        never kept.
+        """
+        generation = self._generation
+        # Read first, if rules change meanwhile the version is already outdated
+        version = get_rules_version()
+        codenames = dict((rule.codename, rule) for rule in self._get_rules())
+
+        # Rules by the model class of their content type, kept under the None key
+        declared = {}
+        for rule in codenames.values():
+            if rule.model_class is not None:
+                declared.setdefault(rule.model_class, {})[rule.codename] = rule
+        snapshot = (codenames, {None: declared}, version)
+
+        self._lock.acquire()
+        try:
+            if generation == self._generation and not [key for key in self._pending if key[0] != thread.get_ident()]:
+                self._snapshot = snapshot
+        finally:
+            self._lock.release()
+        return snapshot
+
+    def _forget_ended_transactions(self):
+        """
+        Forgets the uncommitted rule changes of the current thread once its
+        transaction has been committed or rolled back, and those that expired,
+        emptying the registry
+        """
+        ident = thread.get_ident()
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key, expires in self._pending.items():
+                # Transaction state is per thread, only the thread of the change can read it
+                if expires < now or (key[0] == ident and not connections[key[1]].is_dirty()):
+                    del self._pending[key]
+                    self._generation += 1
+                    self._snapshot = None
+        finally:
+            self._lock.release()
+
+    def _get_snapshot(self):
+        if self._pending:
+            self._forget_ended_transactions()
+        snapshot = self._snapshot
+        if snapshot is None:
+            snapshot = self._load()
+        return snapshot
+
+    def get_by_codename(self, codename):
+        """
+        Returns the rule with that codename or None
+        """
+        return self._get_snapshot()[0].get(codename)
+
+    def get_for_model(self, codename, model_class):
+        """
+        Returns the rule with that codename that applies to model_class or None.
+        The rule can be on model_class, on one of its parents or on the model it proxies.
+        """
+        models = self._get_snapshot()[1]
+        try:
+            rules = models[model_class]
+        except KeyError:
+            rules = models[model_class] = self._inherit(model_class, models[None])
+        return rules.get(codename)
+
+    def get_rules_version(self):
+        """
+        Returns the rules version of the shared cache when the rules were loaded
+        """
+        return self._get_snapshot()[2]
+
+    def _inherit(self, model_class, declared):
+        # Rules of the closest classes override those of their parents
+        rules = {}
+        for klass in reversed(model_class.__mro__):
+            rules.update(declared.get(klass, ()))
+        return rules
+
+    def warm_up(self):
+        """
+        Loads all rules, resolving their models and compiling their evaluators,
+        so the first checks are as fast as the rest. Raises RulesError listing
+        every obsolete rule. Returns the number of rules.
+        """
+        codenames = self._load()[0]
+
+        errors = []
+        for codename, rule in sorted(codenames.items()):
+            if rule.model_class is None:
+                errors.append("Model of rule %s does not longer exist" % codename)
+                continue
+            try:
+                validate_rule(codename, rule.field_name, rule.model_class)
+            except RulesError, e:
+                errors.append(str(e))
+
+        if errors:
+            raise RulesError("Obsolete rules found:\n%s" % '\n'.join(errors))
+        return len(codenames)
+
+    def invalidate(self, **kwargs):
+        """
+        Empties the registry. It can be used as a signal receiver. Signals of
+        RulePermission are sent before the change is committed, so until that
+        transaction ends, settle is called by the same thread or PENDING_TIMEOUT
+        seconds pass, rules loaded by other threads are not kept.
+        """
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._snapshot = None
+            using = kwargs.get('using') or DEFAULT_DB_ALIAS
+            if 'signal' in kwargs and connections[using].is_managed():
+                self._pending[(thread.get_ident(), using)] = time.time() + PENDING_TIMEOUT
+        finally:
+            self._lock.release()
+
+    def settle(self, **kwargs):
+        """
+        Empties the registry if the current thread changed rules, once they have
+        been committed or rolled back. It is called when a request finishes and
+        it can be used as a signal receiver.
+        """
+        if not self._pending:
+            return
+
+        ident = thread.get_ident()
+        self._lock.acquire()
+        try:
+            keys = [key for key in self._pending if key[0] == ident]
+            for key in keys:
+                del self._pending[key]
+            if keys:
+                self._generation += 1
+                self._snapshot = None
+        finally:
+            self._lock.release()
+
+
+registry = RuleRegistry()
+
+post_save.connect(registry.invalidate, sender=RulePermission, dispatch_uid='django_rules.registry.save')
+post_delete.connect(registry.invalidate, sender=RulePermission, dispatch_uid='django_rules.registry.delete')
+# TransactionMiddleware has committed or rolled back by then
+request_finished.connect(registry.settle, dispatch_uid='django_rules.registry.settle')
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Template tags to check rules on every row of a list with a constant number of lookups.
+
+    {% load rules %}
+    {% get_perms_map request.user "can_edit,can_ship" for items as items_perms %}
+    {% for item in items %}
+        {% with items_perms|perms_for:item as perms %}
+            {% if perms.can_edit %}...{% endif %}
+        {% endwith %}
+    {% endfor %}
+"""
+from django import template
+
+from django_rules.backends import ObjectPermissionBackend
+
+register = template.Library()
+
+
+class PermsMap(object):
+    """
+    Decisions of get_perms_map by object
+    """
+    def __init__(self, objects, perms_map):
+        self._decisions = dict((self._key(obj), decisions) for obj, decisions in zip(objects, perms_map))
+
+    def _key(self, obj):
+        # Unsaved objects can only be told apart by identity
+        if obj.pk is None:
+            return id(obj)
+        return (obj.__class__, obj.pk)
+
+    def get(self, obj):
+        """
+        Returns the dictionary of decisions by perm for obj, empty if obj was not checked
+        """
+        return self._decisions.get(self._key(obj), {})
+
+
+class PermsMapNode(template.Node):
+    def __init__(self, user, perms, objects, varname):
+        self.user = user
+        self.perms = perms
+        self.objects = objects
+        self.varname = varname
+
+    def render(self, context):
+        perms = self.perms.resolve(context)
+        if isinstance(perms, basestring):
+            perms = [perm.strip() for perm in perms.split(',') if perm.strip()]
+        objects = list(self.objects.resolve(context) or ())
+
+        perms_map = ObjectPermissionBackend().get_perms_map(self.user.resolve(context), perms, objects)
+        context[self.varname] = PermsMap(objects, perms_map)
+        return ''
+
+
+@register.tag
+def get_perms_map(parser, token):
+    """
+    {% get_perms_map user perms for objects as varname %}
+
+    Checks every perm on every object at once. perms is a list of codenames or
+    a string of comma separated codenames. Use the perms_for filter to get the
+    decisions of an object.
+    """
+    bits = token.split_contents()
+    if len(bits) != 7 or bits[3] != 'for' or bits[5] != 'as':
+        raise template.TemplateSyntaxError("%r tag should be used as {%% %s user perms for objects as varname %%}" %
+                                            (bits[0], bits[0]))
+    return PermsMapNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]),
+                        parser.compile_filter(bits[4]), bits[6])
+
+
+@register.filter
+def perms_for(perms_map, obj):
+    """
+    Returns the dictionary of decisions by perm of obj in a map of get_perms_map
+    """
+    if not isinstance(perms_map, PermsMap):
+        return {}
+    return perms_map.get(obj)
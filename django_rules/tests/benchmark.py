@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the permission check path, run on the settings of the tests:
+
+    python benchmark.py [--quick] [--output=FILE]
+
+Every benchmark reports the time per operation and the number of queries per
+operation, so results of different releases can be compared.
+"""
+import os, sys
+import time
+from optparse import OptionParser
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'test_settings'
+parent = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+
+sys.path.insert(0, parent)
+
+from django.test.simple import DjangoTestSuiteRunner
+from django.conf import settings
+from django.db import connection, reset_queries
+
+
+def measure(function, number):
+    """
+    Calls function number times. Returns the time and the number of queries per call
+    """
+    reset_queries()
+    start = time.time()
+    for i in xrange(number):
+        function()
+    elapsed = time.time() - start
+    return elapsed / number, float(len(connection.queries)) / number
+
+
+def report(output, name, number, result):
+    seconds, queries = result
+    output.write('%-45s %8s calls %12.2f us/call %10.0f calls/s %6.2f queries/call\n' %
+                    (name, number, seconds * 1000000, seconds and 1 / seconds or 0, queries))
+
+
+def bench_has_perm(output, number):
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from django_rules.models import RulePermission
+    from django_rules.tests.models import Dummy
+
+    user = User.objects.create(username='bench_user')
+    obj = Dummy.objects.create(supplier=user)
+    ctype = ContentType.objects.get_for_model(Dummy)
+    for codename, field_name in (('bench_attribute', 'isDisposable'), ('bench_method', 'canTrash'),
+                                 ('bench_user_method', 'canShip')):
+        RulePermission.objects.create(codename=codename, field_name=field_name, content_type=ctype, view_param_pk='idDummy')
+        # The first check loads the rules
+        user.has_perm(codename, obj)
+        report(output, 'has_perm %s (%s)' % (codename, field_name), number,
+                measure(lambda: user.has_perm(codename, obj), number))
+
+    report(output, 'has_perm nonexistent perm', number, measure(lambda: user.has_perm('bench_nonexistent', obj), number))
+    report(output, 'has_perm model perm', number, measure(lambda: user.has_perm('tests.change_dummy', obj), number))
+
+
+def bench_decorator(output, number):
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from django.http import HttpRequest, HttpResponse
+    from django_rules.decorators import object_permission_required
+    from django_rules.models import RulePermission
+    from django_rules.tests.models import Dummy
+
+    user = User.objects.create(username='bench_decorator_user')
+    obj = Dummy.objects.create(supplier=user)
+    RulePermission.objects.create(codename='bench_view', field_name='canShip', view_param_pk='idView',
+                                  content_type=ContentType.objects.get_for_model(Dummy))
+
+    def view(request, idView):
+        return HttpResponse('')
+
+    request = HttpRequest()
+    request.user = user
+    decorated_view = object_permission_required('bench_view')(view)
+
+    decorated_view(request, idView=obj.pk)
+    plain = measure(lambda: view(request, idView=obj.pk), number)
+    decorated = measure(lambda: decorated_view(request, idView=obj.pk), number)
+    report(output, 'view', number, plain)
+    report(output, 'object_permission_required view', number, decorated)
+    output.write('%-45s %33.2f us/call\n' % ('object_permission_required overhead', (decorated[0] - plain[0]) * 1000000))
+
+
+def bench_sync(output, sizes):
+    from django_rules import utils
+    from django_rules.models import RulePermission
+
+    field_names = ('isDisposable', 'canTrash', 'canShip')
+    for size in sizes:
+        RulePermission.objects.all().delete()
+        utils.clear_registered_rules()
+        for i in xrange(size):
+            utils.register(app_name='tests', codename='bench_sync_%s' % i, model='Dummy',
+                           field_name=field_names[i % len(field_names)])
+
+        report(output, 'sync %s new rules' % size, 1, measure(utils.sync, 1))
+        report(output, 'sync %s unchanged rules' % size, 1, measure(utils.sync, 1))
+    utils.clear_registered_rules()
+
+
+def benchmark():
+    parser = OptionParser(usage='%prog [--quick] [--output=FILE]')
+    parser.add_option('--quick', action='store_true', dest='quick', default=False,
+                      help='Run fewer iterations and smaller syncs')
+    parser.add_option('--output', dest='output', default=None,
+                      help='Append the results to this file too')
+    options, args = parser.parse_args()
+
+    number = options.quick and 1000 or 10000
+    sizes = options.quick and (10, 1000) or (10, 1000, 10000)
+
+    # Queries are only logged in DEBUG mode
+    settings.DEBUG = True
+    runner = DjangoTestSuiteRunner(verbosity=0)
+    old_config = runner.setup_databases()
+    try:
+        output = Output(options.output)
+        output.write('django-rules benchmark, %s\n' % time.strftime('%Y-%m-%d %H:%M:%S'))
+        bench_has_perm(output, number)
+        bench_decorator(output, number)
+        bench_sync(output, sizes)
+        output.close()
+    finally:
+        runner.teardown_databases(old_config)
+
+
+class Output(object):
+    """
+    Writes to stdout and, if path is given, to that file
+    """
+    def __init__(self, path=None):
+        self.stream = path and open(path, 'a')
+
+    def write(self, text):
+        sys.stdout.write(text)
+        if self.stream:
+            self.stream.write(text)
+
+    def close(self):
+        if self.stream:
+            self.stream.close()
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 
+from django_rules.evaluators import rule_query
+from django_rules.composite import And, Or, Not
+
 class Dummy(models.Model):
     """
     Dummy model for testing permissions
@@ -9,7 +13,14 @@ class Dummy(models.Model):
     idDummy = models.AutoField(primary_key = True)
     supplier = models.ForeignKey(User, null = False)
     name = models.CharField(max_length = 20, null = True)
+    isPublic = models.BooleanField(default = False)
+
+    # Composite rules
+    canManage = Or('canShip', 'isPublic')
+    canPublish = And('canShip', Not('isPublic'))
+    canDispose = And('isDisposable', 'canTrash')
 
+    @rule_query(lambda user_obj: Q(supplier=user_obj))
     def canShip(self,user_obj):
         """
         Only the supplier can_ship in our business logic.
@@ -45,3 +56,18 @@ class Dummy(models.Model):
         pass
         
 
+
+
+class ChildDummy(Dummy):
+    """
+    Multi-table child of Dummy, rules of Dummy apply to it
+    """
+    isUrgent = models.BooleanField(default = False)
+
+
+class ProxyDummy(Dummy):
+    """
+    Proxy of Dummy, rules of Dummy apply to it
+    """
+    class Meta:
+        proxy = True
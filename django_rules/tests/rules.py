@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from django_rules import utils
+
+rules_list = [
+    # Dummy model
+    {'codename':'can_ship', 'model':'Dummy', 'field_name':'canShip', 'description':"Only supplier has the authorization to ship"},
+    {'codename':'canTrash', 'model':'Dummy'},
+]
+
+for rule in rules_list:
+    utils.register(app_name='tests', **rule)
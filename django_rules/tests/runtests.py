@@ -16,7 +16,21 @@ def runtests():
         'django_rules.BackendTest',
         'django_rules.RulePermissionTest',
         'django_rules.UtilsTest',
-        'django_rules.DecoratorsTest'
+        'django_rules.DecoratorsTest',
+        'django_rules.RegistryTest',
+        'django_rules.InheritanceTest',
+        'django_rules.EvaluatorTest',
+        'django_rules.CompositeTest',
+        'django_rules.FilterObjectsTest',
+        'django_rules.FilterQuerysetTest',
+        'django_rules.PermsMapTest',
+        'django_rules.TemplateTagTest',
+        'django_rules.RequestCacheTest',
+        'django_rules.SharedCacheTest',
+        'django_rules.InstrumentationTest',
+        'django_rules.SyncRulesTest',
+        'django_rules.ManifestTest',
+        'django_rules.MultiDatabaseTest',
         ], verbosity=1, interactive=True)
 
 if __name__ == '__main__':
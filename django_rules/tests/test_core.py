@@ -1,17 +1,42 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
+import tempfile
+import threading
+from StringIO import StringIO
+
 from django.test import TestCase
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.conf import settings
+from django.core.management import call_command
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.core.management.base import CommandError
+from django.http import HttpRequest, HttpResponse
+from django.template import Template, Context, TemplateSyntaxError
 
 from django_rules.models import RulePermission
-from models import Dummy
+from models import Dummy, ChildDummy, ProxyDummy
 from django_rules.exceptions import NonexistentFieldName
 from django_rules.exceptions import NotBooleanPermission
 from django_rules.exceptions import NonexistentPermission
 from django_rules.exceptions import RulesError
 from django_rules import utils
+from django_rules.manifest import dump_manifest, read_manifest, register_manifest
+from django_rules.management.commands.sync_rules import Command as SyncRulesCommand, discover_rules
+from django_rules.management.commands.check_rules import Command as CheckRulesCommand
+from django_rules.management.commands.rules_stats import Command as RulesStatsCommand, format_stats
+from django_rules.registry import registry, RuleRecord
+from django_rules.backends import get_anonymous_user, refresh_anonymous_user
+from django_rules.backends import get_central_authorizations
+from django_rules.backends import ObjectPermissionBackend
+from django_rules import evaluators
+from django_rules.composite import And, Or
+from django_rules.middleware import RulesCacheMiddleware
+from django_rules.instrumentation import get_collector, permission_checked
+from django_rules.cache import get_request_cache, start_request_cache, clear_request_cache
+from django_rules.cache import get_rules_version, bump_rules_version
 
 class BackendTest(TestCase):
     def setUp(self):
@@ -59,6 +84,21 @@ class BackendTest(TestCase):
         anonymous_user = AnonymousUser()
         self.assertFalse(anonymous_user.has_perm('can_ship', self.obj))
 
+    def test_anonymous_user_is_cached(self):
+        refresh_anonymous_user()
+        self.assertEqual(get_anonymous_user().username, 'anonymous')
+        self.assertNumQueries(0, get_anonymous_user)
+
+    def test_anonymous_user_lightweight(self):
+        anonymous_user_id = settings.ANONYMOUS_USER_ID
+        settings.ANONYMOUS_USER_ID = None
+        try:
+            self.assertEqual(get_anonymous_user(), None)
+            RulePermission.objects.create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+            self.assertTrue(AnonymousUser().has_perm('can_trash', self.obj))
+        finally:
+            settings.ANONYMOUS_USER_ID = anonymous_user_id
+
     def test_not_active_superuser(self):
         self.assertFalse(self.not_active_superuser.has_perm('can_ship', self.obj))
 
@@ -115,6 +155,22 @@ class BackendTest(TestCase):
         self.assertRaises(RulesError, lambda:self.user.has_perm('can_ship', self.obj))
         del settings.CENTRAL_AUTHORIZATIONS
 
+    def test_central_authorizations_errors_are_not_hidden(self):
+        settings.CENTRAL_AUTHORIZATIONS = 'utils4'
+        self.assertRaises(TypeError, lambda:self.user.has_perm('broken_perm', self.obj))
+        del settings.CENTRAL_AUTHORIZATIONS
+
+    def test_central_authorizations_chain(self):
+        settings.CENTRAL_AUTHORIZATIONS = ('utils4', 'utils')
+        self.assertTrue(self.otherUser.has_perm('all_can_pass', self.obj))
+        self.assertFalse(self.otherUser.has_perm('can_ship', self.obj))
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+
+        central_authorizations = get_central_authorizations()
+        self.assertEqual([c.module for c in central_authorizations], ['utils4', 'utils'])
+        self.assertEqual([c.calls for c in central_authorizations], [3, 3])
+        del settings.CENTRAL_AUTHORIZATIONS
+
 
 class RulePermissionTest(TestCase):
     def setUp(self):
@@ -148,6 +204,12 @@ class RulePermissionTest(TestCase):
 
 
 class UtilsTest(TestCase):
+    def setUp(self):
+        utils.clear_registered_rules()
+
+    def tearDown(self):
+        utils.clear_registered_rules()
+
     def test_register_valid_rules(self):
         rules_list = [
             # Dummy model
@@ -181,4 +243,794 @@ class UtilsTest(TestCase):
         except Exception:
             self.fail("test_register_valid_rules_compact_style failed")
 
+    def test_register_does_not_touch_database(self):
+        self.assertNumQueries(0, lambda: utils.register(app_name="tests", codename='can_ship', model='Dummy', field_name='canShip'))
+        self.assertEqual(utils.get_registered_rules()['can_ship']['view_param_pk'], 'idDummy')
+
+    def test_sync(self):
+        utils.register(app_name="tests", codename='can_ship', model='Dummy', field_name='canShip')
+        utils.register(app_name="tests", codename='canTrash', model='Dummy')
+        self.assertEqual(utils.sync(), (['canTrash', 'can_ship'], [], []))
+        self.assertEqual(RulePermission.objects.get(pk='canTrash').field_name, 'canTrash')
+
+        # Nothing changed, only fingerprints are read
+        self.assertNumQueries(1, lambda: self.assertEqual(utils.sync(), ([], [], [])))
+
+        utils.clear_registered_rules()
+        utils.register(app_name="tests", codename='can_ship', model='Dummy', field_name='canShip', description='Changed')
+        self.assertEqual(utils.sync(), ([], ['can_ship'], []))
+        self.assertEqual(RulePermission.objects.get(pk='can_ship').description, 'Changed')
+
+    def test_sync_rule_changed_in_database(self):
+        utils.register(app_name="tests", codename='can_ship', model='Dummy', field_name='canShip')
+        utils.sync()
+        rule = RulePermission.objects.get(pk='can_ship')
+        rule.field_name = 'canTrash'
+        rule.save()
+        self.assertEqual(utils.sync(), ([], ['can_ship'], []))
+        self.assertEqual(RulePermission.objects.get(pk='can_ship').field_name, 'canShip')
+
+    def test_sync_prune(self):
+        ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.create(codename='stale_rule', field_name='canTrash', content_type=ctype, view_param_pk='idDummy')
+        utils.register(app_name="tests", codename='can_ship', model='Dummy', field_name='canShip')
+        self.assertEqual(utils.sync(), (['can_ship'], [], []))
+        self.assertEqual(utils.sync(prune=True), ([], [], ['stale_rule']))
+        self.assertEqual(list(RulePermission.objects.values_list('codename', flat=True)), ['can_ship'])
+
+    def test_sync_prune_in_chunks(self):
+        ctype = ContentType.objects.get_for_model(Dummy)
+        stale = ['stale_rule_%s' % i for i in range(5)]
+        for codename in stale:
+            RulePermission.objects.create(codename=codename, field_name='canTrash', content_type=ctype, view_param_pk='idDummy')
+        chunk_size = utils.DELETE_CHUNK_SIZE
+        utils.DELETE_CHUNK_SIZE = 2
+        try:
+            self.assertEqual(utils.sync(prune=True), ([], [], stale))
+        finally:
+            utils.DELETE_CHUNK_SIZE = chunk_size
+        self.assertEqual(RulePermission.objects.count(), 0)
+
+
+class SyncRulesTest(TestCase):
+    def setUp(self):
+        utils.clear_registered_rules()
+        # rules.py registers its rules when imported
+        sys.modules.pop('django_rules.tests.rules', None)
+
+    def tearDown(self):
+        utils.clear_registered_rules()
+
+    def test_sync_rules(self):
+        call_command('sync_rules', 'django_rules.tests', verbosity=0)
+        self.assertEqual(sorted(RulePermission.objects.values_list('codename', flat=True)), ['canTrash', 'can_ship'])
+
+    def test_sync_rules_manifests(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('sync_rules', 'django_rules.tests', verbosity=0, manifest=path)
+            RulePermission.objects.all().delete()
+            utils.clear_registered_rules()
+            call_command('sync_rules', verbosity=0, from_manifest=path)
+        finally:
+            os.remove(path)
+        self.assertEqual(sorted(RulePermission.objects.values_list('codename', flat=True)), ['canTrash', 'can_ship'])
+
+    def test_invalid_rules(self):
+        Dummy.canTrash, canTrash = Dummy.invalidNumberParameters, Dummy.canTrash
+        evaluators.clear_evaluators()
+        try:
+            self.assertRaises(CommandError, lambda: discover_rules(['django_rules.tests'], verbosity=0))
+        finally:
+            Dummy.canTrash = canTrash
+            evaluators.clear_evaluators()
+
+    def test_prune_needs_all_apps(self):
+        self.assertRaises(CommandError, lambda: SyncRulesCommand().handle('django_rules.tests', verbosity=0, prune=True, fixture=False))
+
+
+class MultiDatabaseTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        utils.clear_registered_rules()
+        utils.register(app_name='tests', codename='can_ship', model='Dummy', field_name='canShip')
+
+    def tearDown(self):
+        utils.clear_registered_rules()
+        registry.invalidate()
+        if hasattr(settings, 'RULES_DATABASE'):
+            del settings.RULES_DATABASE
+
+    def _codenames(self, using):
+        return list(RulePermission.objects.using(using).values_list('codename', flat=True))
+
+    def test_sync_into_database(self):
+        self.assertEqual(utils.sync(using='replica'), (['can_ship'], [], []))
+        self.assertEqual(self._codenames('replica'), ['can_ship'])
+        self.assertEqual(self._codenames('default'), [])
+
+    def test_sync_rules_propagate(self):
+        SyncRulesCommand().handle('django_rules', verbosity=0, fixture=False, prune=False, propagate='replica')
+        self.assertEqual(self._codenames('default'), ['can_ship'])
+        self.assertEqual(self._codenames('replica'), ['can_ship'])
+
+        # Propagation only writes what changed in every database
+        RulePermission.objects.using('replica').all().delete()
+        self.assertEqual(utils.sync(), ([], [], []))
+        self.assertEqual(utils.sync(using='replica'), (['can_ship'], [], []))
+
+    def test_rules_database(self):
+        utils.sync(using='replica')
+        registry.invalidate()
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+        settings.RULES_DATABASE = 'replica'
+        registry.invalidate()
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertTrue(registry.get_by_codename('can_ship').model_class is Dummy)
+
+
+class ManifestTest(TestCase):
+    def setUp(self):
+        utils.clear_registered_rules()
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy',
+                                        description="Only supplier have the authorization to ship", cache_timeout=60)
+        RulePermission.objects.create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+        self.manifest = StringIO()
+        dump_manifest(self.manifest)
+        self.manifest.seek(0)
+
+    def tearDown(self):
+        utils.clear_registered_rules()
+
+    def test_dump_and_read(self):
+        rules = list(read_manifest(self.manifest))
+        self.assertEqual([rule['codename'] for rule in rules], ['can_ship', 'can_trash'])
+        self.assertEqual(rules[0]['model'], 'dummy')
+        self.assertEqual(rules[0]['cache_timeout'], 60)
+        self.assertEqual(rules[0]['fingerprint'], RulePermission.objects.get(pk='can_ship').fingerprint)
+
+    def test_invalid_manifest(self):
+        self.assertRaises(RulesError, lambda: list(read_manifest(StringIO('{"format": "django-rules", "version": 2}\n'))))
+        self.assertRaises(RulesError, lambda: list(read_manifest(StringIO('[]\n'))))
+        self.assertRaises(RulesError, lambda: list(read_manifest(StringIO('{"format": "django-rules", "version": 1}\n{"codename": 1}\n'))))
+
+    def test_register_manifest(self):
+        RulePermission.objects.all().delete()
+        self.assertEqual(register_manifest(self.manifest), 2)
+        self.assertEqual(utils.sync(), (['can_ship', 'can_trash'], [], []))
+        self.assertEqual(RulePermission.objects.get(pk='can_ship').cache_timeout, 60)
+
+    def test_registry_from_manifest(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, self.manifest.getvalue())
+        os.close(fd)
+        settings.RULES_MANIFEST = path
+        try:
+            RulePermission.objects.all().delete()
+            # Not even ContentTypes are looked up
+            ContentType.objects.clear_cache()
+            self.assertNumQueries(0, lambda: self.assertTrue(self.user.has_perm('can_trash', self.obj)))
+        finally:
+            del settings.RULES_MANIFEST
+            registry.invalidate()
+            os.remove(path)
+
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        self.ctype = ContentType.objects.get_for_model(self.obj)
+        self.rule = RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy',
+                                            description="Only supplier have the authorization to ship")[0]
+
+    def test_checks_do_not_query_once_loaded(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertNumQueries(0, lambda: self.user.has_perm('can_ship', self.obj))
+        self.assertNumQueries(0, lambda: self.user.has_perm('nonexistent_perm', self.obj))
+
+    def test_rule_records(self):
+        rule = registry.get_by_codename('can_ship')
+        self.assertTrue(isinstance(rule, RuleRecord))
+        self.assertEqual(rule, ('can_ship', 'canShip', Dummy, 'idDummy', None))
+        self.assertRaises(AttributeError, lambda: setattr(rule, 'field_name', 'canTrash'))
+        self.assertRaises(AttributeError, lambda: setattr(rule, 'description', ''))
+
+    def test_unknown_perms_do_not_query(self):
+        self.assertFalse(self.user.has_perm('nonexistent_perm', self.obj))
+        self.assertNumQueries(0, lambda: self.user.has_perm('other_nonexistent_perm', self.obj))
+        # Models without rules neither
+        self.assertNumQueries(0, lambda: self.user.has_perm('can_ship', self.user))
+
+    def test_dotted_perms_are_rejected(self):
+        registry.invalidate()
+        settings.CENTRAL_AUTHORIZATIONS = 'utils4'
+        try:
+            # Neither the registry is loaded nor the central authorizations called
+            self.assertNumQueries(0, lambda: ObjectPermissionBackend().has_perm(self.user, 'tests.broken_perm', self.obj))
+            self.assertNumQueries(0, lambda: ObjectPermissionBackend().has_perm(self.user, 'tests.change_dummy', self.obj))
+        finally:
+            del settings.CENTRAL_AUTHORIZATIONS
+        self.assertRaises(RulesError, lambda: utils.register(app_name='tests', codename='tests.can_ship', model='Dummy', field_name='canShip'))
+
+    def test_dotted_perms_are_rejected_for_many_objects(self):
+        objs = [self.obj]
+        superuser = User.objects.create(username='miguel', is_active=True, is_superuser=True)
+        settings.CENTRAL_AUTHORIZATIONS = 'utils'
+        try:
+            backend = ObjectPermissionBackend()
+            # Central authorizations are not asked, even though all_can_pass would be True
+            self.assertEqual(backend.filter_objects(self.user, 'tests.all_can_pass', objs), [])
+            self.assertEqual(backend.filter_objects(self.user, 'tests.all_can_pass', objs, mask=True), [False])
+            self.assertEqual(list(backend.filter_queryset(self.user, 'tests.all_can_pass', Dummy.objects.all())), [])
+            self.assertEqual(list(RulePermission.objects.queryset_for(superuser, 'tests.change_dummy', Dummy.objects.all())), [])
+            self.assertEqual(backend.get_perms_map(superuser, ['tests.change_dummy', 'can_ship'], objs),
+                             [{'tests.change_dummy': False, 'can_ship': True}])
+        finally:
+            del settings.CENTRAL_AUTHORIZATIONS
+
+    def test_warm_up(self):
+        self.assertEqual(registry.warm_up(), 1)
+        call_command('check_rules', verbosity=0)
+        self.assertNumQueries(0, lambda: self.user.has_perm('can_ship', self.obj))
+
+    def test_warm_up_obsolete_rule(self):
+        RulePermission.objects.create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+        canTrash = Dummy.canTrash
+        del Dummy.canTrash
+        evaluators.clear_evaluators()
+        try:
+            self.assertRaises(RulesError, registry.warm_up)
+            self.assertRaises(CommandError, lambda: CheckRulesCommand().handle_noargs(verbosity=0))
+        finally:
+            Dummy.canTrash = canTrash
+            evaluators.clear_evaluators()
+
+    def test_rule_of_removed_model(self):
+        ctype = ContentType.objects.create(app_label='tests', model='removeddummy', name='removed dummy')
+        # save would refuse the rule, its model does not exist
+        RulePermission(codename='can_remove', field_name='canRemove', content_type=ctype,
+                       view_param_pk='idDummy').save_base(force_insert=True)
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertEqual(registry.get_by_codename('can_remove').model_class, None)
+        try:
+            registry.warm_up()
+        except RulesError, e:
+            self.assertEqual(str(e), "Obsolete rules found:\nModel of rule can_remove does not longer exist")
+        else:
+            self.fail("RulesError not raised")
+
+    def test_invalidated_while_loading(self):
+        get_rules = registry._get_rules
+        def get_rules_and_invalidate():
+            rules = get_rules()
+            registry.invalidate()
+            return rules
+        registry.invalidate()
+        registry._get_rules = get_rules_and_invalidate
+        try:
+            self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        finally:
+            del registry._get_rules
+        # The outdated rules were not kept
+        self.assertNumQueries(1, lambda: self.user.has_perm('can_ship', self.obj))
+
+    def test_uncommitted_changes(self):
+        def load_in_thread():
+            loader = threading.Thread(target=registry.get_by_codename, args=('can_ship',))
+            loader.start()
+            loader.join()
+
+        # Other threads would use their own in-memory database
+        registry._get_rules = lambda: []
+        try:
+            # The test runs in a transaction, so the change is not committed
+            self.rule.description = 'Changed'
+            self.rule.save()
+            load_in_thread()
+            self.assertEqual(registry._snapshot, None)
+
+            # This thread sees its own changes
+            registry.get_by_codename('can_ship')
+            self.assertNotEqual(registry._snapshot, None)
+
+            registry.settle()
+            self.assertEqual(registry._snapshot, None)
+            load_in_thread()
+            self.assertNotEqual(registry._snapshot, None)
+        finally:
+            del registry._get_rules
+            registry.invalidate()
+
+    def test_uncommitted_changes_end(self):
+        def load_in_thread():
+            loader = threading.Thread(target=registry.get_by_codename, args=('can_ship',))
+            loader.start()
+            loader.join()
+
+        registry._get_rules = lambda: []
+        connection = connections[DEFAULT_DB_ALIAS]
+        try:
+            # Outside requests, the transaction ending is noticed by the thread on its next check
+            self.rule.save()
+            registry.get_by_codename('can_ship')
+            connection.set_clean()
+            registry.get_by_codename('can_ship')
+            self.assertEqual(registry._pending, {})
+            load_in_thread()
+            self.assertNotEqual(registry._snapshot, None)
+
+            # Or by any thread once it expires
+            connection.set_dirty()
+            self.rule.save()
+            registry._pending = dict.fromkeys(registry._pending, 0)
+            load_in_thread()
+            self.assertEqual(registry._pending, {})
+            self.assertNotEqual(registry._snapshot, None)
+        finally:
+            del registry._get_rules
+            registry.invalidate()
+
+    def test_invalidated_on_save(self):
+        self.assertFalse(self.user.has_perm('can_trash', self.obj))
+        RulePermission.objects.create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+        self.assertTrue(self.user.has_perm('can_trash', self.obj))
+
+    def test_invalidated_on_delete(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.rule.delete()
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+
+class InheritanceTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.child = ChildDummy.objects.create(supplier=self.user)
+        self.proxy = ProxyDummy.objects.create(supplier=self.user)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', view_param_pk='idDummy',
+                                             content_type=ContentType.objects.get_for_model(Dummy))
+        RulePermission.objects.get_or_create(codename='is_urgent', field_name='isUrgent', view_param_pk='idDummy',
+                                             content_type=ContentType.objects.get_for_model(ChildDummy))
+
+    def test_parent_rules_apply(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.child))
+        self.assertFalse(self.otherUser.has_perm('can_ship', self.child))
+        self.assertTrue(self.user.has_perm('can_ship', self.proxy))
+        self.assertFalse(self.otherUser.has_perm('can_ship', self.proxy))
+
+    def test_child_rules_do_not_apply_to_parent(self):
+        self.assertTrue(registry.get_for_model('is_urgent', ChildDummy) is not None)
+        self.assertEqual(registry.get_for_model('is_urgent', Dummy), None)
+        self.assertEqual(registry.get_for_model('is_urgent', ProxyDummy), None)
+
+    def test_index_is_resolved_once(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.child))
+        self.assertNumQueries(0, lambda: self.user.has_perm('can_ship', self.child))
+        self.assertNumQueries(0, lambda: self.user.has_perm('nonexistent_perm', self.proxy))
+
+    def test_filter_queryset(self):
+        pks = RulePermission.objects.queryset_for(self.otherUser, 'can_ship', ChildDummy.objects.all()).values_list('pk', flat=True)
+        self.assertEqual(list(pks), [])
+        pks = RulePermission.objects.queryset_for(self.user, 'can_ship', ProxyDummy.objects.order_by('pk')).values_list('pk', flat=True)
+        self.assertEqual(list(pks), [self.child.pk, self.proxy.pk])
+
+
+class EvaluatorTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+
+    def test_kinds(self):
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'canShip').kind, evaluators.USER_METHOD)
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'canTrash').kind, evaluators.METHOD)
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'isDisposable').kind, evaluators.ATTRIBUTE)
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'name').kind, evaluators.ATTRIBUTE)
+
+    def test_compiled_once(self):
+        self.assertTrue(evaluators.get_evaluator(Dummy, 'canShip') is evaluators.get_evaluator(Dummy, 'canShip'))
+
+    def test_evaluate(self):
+        evaluator = evaluators.get_evaluator(Dummy, 'canShip')
+        self.assertTrue(evaluator(self.obj, self.user))
+        self.assertFalse(evaluator(self.obj, self.otherUser))
+        self.assertRaises(NotBooleanPermission, lambda: evaluators.get_evaluator(Dummy, 'methodInteger')(self.obj, self.user))
+
+    def test_invalid_field_names(self):
+        self.assertRaises(NonexistentFieldName, lambda: evaluators.get_evaluator(Dummy, 'invalidField'))
+        self.assertRaises(RulesError, lambda: evaluators.get_evaluator(Dummy, 'invalidNumberParameters'))
+
 
+class CompositeTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.obj = Dummy.objects.create(supplier=self.user)
+        self.publicObj = Dummy.objects.create(supplier=self.user, isPublic=True)
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.get_or_create(codename='can_manage', field_name='canManage', content_type=self.ctype, view_param_pk='idDummy')
+        RulePermission.objects.get_or_create(codename='can_publish', field_name='canPublish', content_type=self.ctype, view_param_pk='idDummy')
+        evaluators.clear_evaluators()
+
+    def tearDown(self):
+        for name in ('canLoop', 'canLoopBack', 'canBreak'):
+            if name in Dummy.__dict__:
+                delattr(Dummy, name)
+        evaluators.clear_evaluators()
+
+    def test_evaluate(self):
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'canManage').kind, evaluators.COMPOSITE)
+        self.assertTrue(self.user.has_perm('can_manage', self.obj))
+        self.assertFalse(self.otherUser.has_perm('can_manage', self.obj))
+        self.assertTrue(self.otherUser.has_perm('can_manage', self.publicObj))
+        self.assertTrue(self.user.has_perm('can_publish', self.obj))
+        self.assertFalse(self.user.has_perm('can_publish', self.publicObj))
+
+    def test_operators(self):
+        composite = Or('canShip', 'isPublic') & ~And('isDisposable')
+        self.assertEqual(repr(composite), "And(Or('canShip', 'isPublic'), Not(And('isDisposable')))")
+        self.assertRaises(ValueError, Or)
+
+    def test_memo(self):
+        memo = {}
+        self.assertTrue(evaluators.get_evaluator(Dummy, 'canManage')(self.obj, self.user, memo))
+        self.assertEqual(memo, {'canShip': True, 'canManage': True})
+
+        # Sub-results in memo are not evaluated again
+        memo = {'canShip': False}
+        self.assertFalse(evaluators.get_evaluator(Dummy, 'canPublish')(self.obj, self.user, memo))
+
+    def test_short_circuit(self):
+        # methodInteger would raise NotBooleanPermission if it was evaluated
+        Dummy.canBreak = Or('canTrash', 'methodInteger')
+        self.assertTrue(evaluators.get_evaluator(Dummy, 'canBreak')(self.obj, self.user))
+
+    def test_cost_ordering(self):
+        Dummy.canBreak = And('canShip', 'canTrash')
+        node = evaluators.get_evaluator(Dummy, 'canBreak').node
+        ship, trash = node.operands
+        ship.time, ship.calls = 10.0, 1
+        node.calls = evaluators.REORDER_INTERVAL
+        evaluators.get_evaluator(Dummy, 'canBreak')(self.obj, self.user)
+        self.assertEqual(node.operands, [trash, ship])
+
+    def test_query(self):
+        pks = RulePermission.objects.queryset_for(self.otherUser, 'can_manage', Dummy.objects.all()).values_list('pk', flat=True)
+        self.assertEqual(list(pks), [self.publicObj.pk])
+        pks = RulePermission.objects.queryset_for(self.user, 'can_publish', Dummy.objects.all()).values_list('pk', flat=True)
+        self.assertEqual(list(pks), [self.obj.pk])
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'canDispose').query, None)
+
+    def test_invalid_composites(self):
+        Dummy.canBreak = And('canShip', 'invalidField')
+        self.assertRaises(NonexistentFieldName, lambda: evaluators.get_evaluator(Dummy, 'canBreak'))
+        Dummy.canLoop = Or('canShip', 'canLoopBack')
+        Dummy.canLoopBack = And('canLoop')
+        self.assertRaises(RulesError, lambda: evaluators.get_evaluator(Dummy, 'canLoop'))
+        self.assertRaises(RulesError, lambda: RulePermission.objects.create(codename='can_loop', field_name='canLoop',
+                                                                             content_type=self.ctype, view_param_pk='idDummy'))
+
+
+class FilterObjectsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.superuser = User.objects.get_or_create(username='miguel', is_active=True, is_superuser=True)[0]
+        self.not_active_user = User.objects.get_or_create(username='rebeca', is_active=False)[0]
+        self.objs = [Dummy.objects.create(supplier=self.user), Dummy.objects.create(supplier=self.otherUser),
+                     Dummy.objects.create(supplier=self.user)]
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        self.backend = ObjectPermissionBackend()
+
+    def test_filter_objects(self):
+        self.assertEqual(self.backend.filter_objects(self.user, 'can_ship', self.objs), [self.objs[0], self.objs[2]])
+        self.assertEqual(self.backend.filter_objects(self.otherUser, 'can_ship', self.objs), [self.objs[1]])
+
+    def test_filter_queryset(self):
+        queryset = Dummy.objects.filter(pk__in=[obj.pk for obj in self.objs]).order_by('pk')
+        self.assertEqual(self.backend.filter_objects(self.otherUser, 'can_ship', queryset), [self.objs[1]])
+
+    def test_mask(self):
+        self.assertEqual(self.backend.filter_objects(self.user, 'can_ship', self.objs, mask=True), [True, False, True])
+        self.assertEqual(self.backend.filter_objects(self.user, 'nonexistent_perm', self.objs, mask=True), [False] * 3)
+
+    def test_superuser_and_not_active_user(self):
+        self.assertEqual(self.backend.filter_objects(self.superuser, 'can_ship', self.objs), self.objs)
+        self.assertEqual(self.backend.filter_objects(self.not_active_user, 'can_ship', self.objs), [])
+
+    def test_no_queries_per_object(self):
+        self.backend.filter_objects(self.user, 'can_ship', self.objs)
+        self.assertNumQueries(0, lambda: self.backend.filter_objects(self.user, 'can_ship', self.objs))
+
+
+class PermsMapTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.superuser = User.objects.get_or_create(username='miguel', is_active=True, is_superuser=True)[0]
+        self.objs = [Dummy.objects.create(supplier=self.user), Dummy.objects.create(supplier=self.otherUser, isPublic=True)]
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        RulePermission.objects.get_or_create(codename='can_manage', field_name='canManage', content_type=self.ctype, view_param_pk='idDummy')
+        self.backend = ObjectPermissionBackend()
+
+    def test_perms_map(self):
+        perms_map = self.backend.get_perms_map(self.user, ['can_ship', 'can_manage', 'nonexistent_perm', 'tests.change_dummy'], self.objs)
+        self.assertEqual(perms_map, [{'can_ship': True, 'can_manage': True, 'nonexistent_perm': False, 'tests.change_dummy': False},
+                                     {'can_ship': False, 'can_manage': True, 'nonexistent_perm': False, 'tests.change_dummy': False}])
+
+    def test_superuser_and_central_authorizations(self):
+        self.assertEqual(self.backend.get_perms_map(self.superuser, ['can_ship'], self.objs), [{'can_ship': True}] * 2)
+        settings.CENTRAL_AUTHORIZATIONS = 'utils'
+        try:
+            perms_map = ObjectPermissionBackend().get_perms_map(self.otherUser, ['can_ship', 'all_can_pass'], self.objs)
+        finally:
+            del settings.CENTRAL_AUTHORIZATIONS
+        self.assertEqual(perms_map, [{'can_ship': False, 'all_can_pass': True}, {'can_ship': True, 'all_can_pass': True}])
+
+    def test_shared_operands_are_evaluated_once(self):
+        calls = []
+        canShip = Dummy.canShip
+        Dummy.canShip = lambda obj, user_obj: calls.append(obj) or canShip(obj, user_obj)
+        evaluators.clear_evaluators()
+        try:
+            self.backend.get_perms_map(self.user, ['can_ship', 'can_manage'], self.objs)
+        finally:
+            Dummy.canShip = canShip
+            evaluators.clear_evaluators()
+        self.assertEqual(calls, self.objs)
+
+    def test_annotate_for(self):
+        objs = RulePermission.objects.annotate_for(self.otherUser, ['can_ship'], Dummy.objects.order_by('pk'))
+        self.assertEqual([obj.perms for obj in objs], [{'can_ship': False}, {'can_ship': True}])
+        self.assertNumQueries(1, lambda: RulePermission.objects.annotate_for(self.otherUser, ['can_ship', 'can_manage'],
+                                                                              Dummy.objects.select_related('supplier')))
+
+
+class TemplateTagTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.objs = [Dummy.objects.create(supplier=self.user, name='first'), Dummy.objects.create(supplier=self.otherUser, name='second')]
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        RulePermission.objects.get_or_create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+
+    def _render(self, source, **context):
+        return Template('{% load rules %}' + source).render(Context(context))
+
+    def test_get_perms_map(self):
+        source = ('{% get_perms_map user "can_ship, can_trash" for objs as objs_perms %}'
+                  '{% for obj in objs %}{% with objs_perms|perms_for:obj as perms %}'
+                  '{{ obj.name }}:{{ perms.can_ship }}:{{ perms.can_trash }} '
+                  '{% endwith %}{% endfor %}')
+        self.assertEqual(self._render(source, user=self.user, objs=Dummy.objects.select_related('supplier').order_by('pk')),
+                         'first:True:True second:False:True ')
+
+    def test_constant_queries(self):
+        source = ('{% get_perms_map user perms for objs as objs_perms %}'
+                  '{% for obj in objs %}{% if objs_perms|perms_for:obj %}x{% endif %}{% endfor %}')
+        self._render(source, user=self.user, perms=['can_ship'], objs=self.objs)
+        for number in range(5):
+            Dummy.objects.create(supplier=self.user)
+        self.assertNumQueries(1, lambda: self._render(source, user=self.user, perms=['can_ship'],
+                                                     objs=Dummy.objects.select_related('supplier')))
+
+    def test_unknown_objects_and_syntax(self):
+        self.assertEqual(self._render('{% get_perms_map user "can_ship" for objs as objs_perms %}{{ objs_perms|perms_for:obj }}',
+                                      user=self.user, objs=self.objs[:1], obj=self.objs[1]), '{}')
+        self.assertRaises(TemplateSyntaxError, lambda: self._render('{% get_perms_map user "can_ship" objs as objs_perms %}'))
+
+
+class FilterQuerysetTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.superuser = User.objects.get_or_create(username='miguel', is_active=True, is_superuser=True)[0]
+        self.objs = [Dummy.objects.create(supplier=self.user, isPublic=True), Dummy.objects.create(supplier=self.otherUser),
+                     Dummy.objects.create(supplier=self.user)]
+        self.ctype = ContentType.objects.get_for_model(Dummy)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        RulePermission.objects.get_or_create(codename='can_see', field_name='isPublic', content_type=self.ctype, view_param_pk='idDummy')
+        RulePermission.objects.get_or_create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idDummy')
+
+    def _pks(self, user_obj, perm):
+        return list(RulePermission.objects.queryset_for(user_obj, perm, Dummy.objects.order_by('pk')).values_list('pk', flat=True))
+
+    def test_boolean_field(self):
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'isPublic').query(self.user).children, [('isPublic', True)])
+        self.assertEqual(self._pks(self.otherUser, 'can_see'), [self.objs[0].pk])
+
+    def test_rule_query(self):
+        self.assertEqual(self._pks(self.user, 'can_ship'), [self.objs[0].pk, self.objs[2].pk])
+        self.assertEqual(self._pks(self.otherUser, 'can_ship'), [self.objs[1].pk])
+
+    def test_rule_without_query(self):
+        self.assertEqual(evaluators.get_evaluator(Dummy, 'canTrash').query, None)
+        # The result is a QuerySet for every user or an error
+        for user_obj in (self.user, self.superuser):
+            self.assertRaises(RulesError, RulePermission.objects.queryset_for, user_obj, 'can_trash', Dummy.objects.all())
+        self.assertEqual(ObjectPermissionBackend().filter_objects(self.user, 'can_trash', Dummy.objects.order_by('pk')), self.objs)
+
+    def test_nonexistent_perm_and_superuser(self):
+        self.assertEqual(self._pks(self.user, 'nonexistent_perm'), [])
+        self.assertEqual(self._pks(self.superuser, 'can_ship'), [obj.pk for obj in self.objs])
+
+
+class RequestCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        self.ctype = ContentType.objects.get_for_model(self.obj)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        self.middleware = RulesCacheMiddleware()
+        self.request = HttpRequest()
+
+    def tearDown(self):
+        self.middleware.process_response(self.request, HttpResponse())
+
+    def test_memoized_during_request(self):
+        self.middleware.process_request(self.request)
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.obj.supplier = self.otherUser
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertEqual(len(get_request_cache()), 1)
+
+        self.middleware.process_response(self.request, HttpResponse())
+        self.assertEqual(get_request_cache(), None)
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+    def test_not_memoized_without_middleware(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.obj.supplier = self.otherUser
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+    def test_never_memoize(self):
+        settings.RULES_NEVER_MEMOIZE = ('can_ship',)
+        try:
+            self.middleware.process_request(self.request)
+            self.assertTrue(self.user.has_perm('can_ship', self.obj))
+            self.obj.supplier = self.otherUser
+            self.assertFalse(self.user.has_perm('can_ship', self.obj))
+        finally:
+            del settings.RULES_NEVER_MEMOIZE
+
+
+class SharedCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.otherUser = User.objects.get_or_create(username='juan', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        self.ctype = ContentType.objects.get_for_model(self.obj)
+        self.rule = RulePermission.objects.create(codename='can_ship', field_name='canShip', content_type=self.ctype,
+                                                    view_param_pk='idDummy', cache_timeout=60)
+
+    def test_cached_decision(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.obj.supplier = self.otherUser
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+
+    def test_not_cached_without_timeout(self):
+        self.rule.cache_timeout = None
+        self.rule.save()
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.obj.supplier = self.otherUser
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+    def test_rules_version(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.obj.supplier = self.otherUser
+        version = get_rules_version()
+        # Rules changed in another process
+        bump_rules_version()
+        self.assertEqual(get_rules_version(), version + 1)
+        # The old rules still use the decisions of the old version
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        # Once the new rules are loaded
+        registry.invalidate()
+        self.assertFalse(self.user.has_perm('can_ship', self.obj))
+
+    def test_version_bumped_by_models(self):
+        # The receivers are connected by models, not by the backend
+        version = get_rules_version()
+        self.rule.description = 'Changed'
+        self.rule.save()
+        self.assertTrue(get_rules_version() > version)
+
+    def test_sync_bumps_rules_version(self):
+        version = get_rules_version()
+        utils.clear_registered_rules()
+        utils.register(app_name='tests', codename='can_trash', model='Dummy', field_name='canTrash')
+        utils.sync()
+        self.assertTrue(get_rules_version() > version)
+
+        # Updates don't send signals
+        version = get_rules_version()
+        utils.clear_registered_rules()
+        utils.register(app_name='tests', codename='can_trash', model='Dummy', field_name='canTrash', description='Changed')
+        self.assertEqual(utils.sync(), ([], ['can_trash'], []))
+        utils.clear_registered_rules()
+        self.assertTrue(get_rules_version() > version)
+
+
+class InstrumentationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.get_or_create(username='javier', is_active=True)[0]
+        self.obj = Dummy.objects.get_or_create(supplier=self.user)[0]
+        self.ctype = ContentType.objects.get_for_model(self.obj)
+        RulePermission.objects.get_or_create(codename='can_ship', field_name='canShip', content_type=self.ctype, view_param_pk='idDummy')
+        settings.RULES_COLLECTOR = 'django_rules.instrumentation.MemoryCollector'
+        get_collector().reset()
+
+    def tearDown(self):
+        clear_request_cache()
+        get_collector().reset()
+        del settings.RULES_COLLECTOR
+
+    def test_memory_collector(self):
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        start_request_cache()
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+
+        stats = get_collector().get_stats()['can_ship']
+        self.assertEqual((stats['checks'], stats['hits'], stats['misses']), (3, 1, 1))
+        self.assertEqual(sum(stats['histogram']), 3)
+
+    def test_cache_collector(self):
+        settings.RULES_COLLECTOR = 'django_rules.instrumentation.CacheCollector'
+        get_collector().reset()
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        self.assertFalse(self.user.has_perm('nonexistent_perm', self.obj))
+        self.assertTrue(self.user.has_perm('can_ship', self.obj))
+
+        stats = get_collector().get_stats()
+        self.assertEqual(sorted(stats.keys()), ['can_ship', 'nonexistent_perm'])
+        self.assertEqual(stats['can_ship']['checks'], 2)
+        self.assertEqual(sum(stats['can_ship']['histogram']), 2)
+
+    def test_signal(self):
+        checks = []
+        def receiver(sender, **kwargs):
+            checks.append(kwargs)
+        permission_checked.connect(receiver)
+        settings.DEBUG = True
+        try:
+            self.assertTrue(self.user.has_perm('can_ship', self.obj))
+        finally:
+            settings.DEBUG = False
+            permission_checked.disconnect(receiver)
+
+        self.assertEqual(len(checks), 1)
+        self.assertEqual((checks[0]['perm'], checks[0]['is_authorized'], checks[0]['cache_hit']), ('can_ship', True, None))
+        # The supplier of the Dummy is fetched to compare it
+        self.assertEqual(checks[0]['queries'], 1)
+
+    def test_invalid_collector(self):
+        settings.RULES_COLLECTOR = 'django_rules.instrumentation.NonexistentCollector'
+        self.assertRaises(RulesError, get_collector)
+        self.assertRaises(CommandError, lambda: RulesStatsCommand().handle_noargs())
+        settings.RULES_COLLECTOR = 'django_rules.instrumentation.MemoryCollector'
+
+    def test_rules_stats_command(self):
+        self.user.has_perm('can_ship', self.obj)
+        self.assertTrue(format_stats(get_collector().get_stats()).splitlines()[1].startswith('can_ship '))
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            RulesStatsCommand().handle_noargs(reset=True)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(get_collector().get_stats(), {})
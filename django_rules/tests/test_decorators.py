@@ -3,6 +3,7 @@ from django.test import TestCase
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
 from django.http import HttpRequest, HttpResponse, Http404, HttpResponseRedirect
+from django.db.models.query import QuerySet
 
 from django_rules.exceptions import RulesError, NonexistentPermission
 from django_rules.models import RulePermission
@@ -69,6 +70,36 @@ class DecoratorsTest(TestCase):
         self.assertTrue(isinstance(response, HttpResponseRedirect))
         self.assertTrue(response._headers['location'][1].startswith('/foobar/'))
 
+    def test_only_object_query(self):
+        RulePermission.objects.get_or_create(codename='can_trash', field_name='canTrash', content_type=self.ctype, view_param_pk='idView')
+        self._dummy_view(self.user, {'perm':'can_trash'}, self.obj.pk)
+        # Only the object is fetched once the rules are loaded
+        self.assertNumQueries(1, lambda: self._dummy_view(self.user, {'perm':'can_trash'}, self.obj.pk))
+
+    def test_select_related(self):
+        self._dummy_view(self.user, {'perm':'can_ship'}, self.obj.pk)
+        # canShip uses the supplier, that would be fetched with another query
+        self.assertNumQueries(1, lambda: self._dummy_view(self.user, {'perm':'can_ship', 'select_related':('supplier',)}, self.obj.pk))
+
+    def test_only(self):
+        response = self._dummy_view(self.user, {'perm':'can_ship', 'only':('supplier',)}, self.obj.pk)
+        self.assertEqual(response.content, 'success')
+
+    def test_prefetch_related(self):
+        if hasattr(QuerySet, 'prefetch_related'):
+            response = self._dummy_view(self.user, {'perm':'can_ship', 'prefetch_related':('supplier__groups',)}, self.obj.pk)
+            self.assertEqual(response.content, 'success')
+        else:
+            self.assertRaises(RulesError, lambda: self._dummy_view(self.user, {'perm':'can_ship', 'prefetch_related':('supplier__groups',)}, self.obj.pk))
+
+    def test_permission_object(self):
+        @object_permission_required('can_ship')
+        def dummy_view(request, idView):
+            return HttpResponse(str(request.permission_object.pk))
+
+        response = dummy_view(self._get_request(self.user), idView=self.obj.pk)
+        self.assertEqual(response.content, str(self.obj.pk))
+
     def test_view_param_pk_not_match_param_in_view(self):
         self.assertRaises(RulesError, lambda: self._dummy_view(self.user, {'perm':'can_supply'}, self.obj.pk))
         
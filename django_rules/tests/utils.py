@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
 def central_authorizations(user_obj, perm):
     # Central authorizations should go here
-    if perm == "all_can_pass":
+    if perm.split(".")[-1] == "all_can_pass":
         return True
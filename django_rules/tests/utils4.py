@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+# Errors raised within the function should not be hidden
+def central_authorizations(user_obj, perm):
+    if perm == "broken_perm":
+        raise TypeError("Error in central_authorizations code")
@@ -3,29 +3,135 @@
 import sys
 
 from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.db.models import get_model
 
-from models import RulePermission
-    
-def register(app_name, codename, model, field_name='', view_param_pk='', description=''):
+from models import RulePermission, validate_rule, get_fingerprint
+from registry import registry
+from cache import bump_rules_version
+
+# Rule definitions registered by rules.py files, by codename, waiting to be synced
+_registered_rules = {}
+
+# RulePermission fields that a rule definition sets
+RULE_FIELDS = ('field_name', 'view_param_pk', 'description', 'cache_timeout', 'fingerprint')
+
+# Rules deleted by every query, below the parameter limits of SQLite (999) and Oracle (1000)
+DELETE_CHUNK_SIZE = 500
+
+
+def register(app_name, codename, model, field_name='', view_param_pk='', description='', cache_timeout=None):
     """
     Call this function in your rules.py to register your RulePermissions
     All registered rules will be synced when sync_rules command is run
+    The rule is validated against the model, but the database is not touched
     """
-    # We get the `ContentType` for that `model` within that `app_name`
-    try:
-        ctype = ContentType.objects.get(app_label = app_name, model = model.lower())
-    except ContentType.DoesNotExist:
+    # We get the model class for that `model` within that `app_name`
+    model_class = get_model(app_name, model)
+    if model_class is None:
         sys.stderr.write('! Rule codenamed %s will not be synced as model %s was not found for app %s\n' % (codename, model, app_name))
         return
 
-    try:
-        # We see if the rule's pk exists, if it does then delete and overwrite it
-        rule = RulePermission.objects.get(pk = codename)
-        rule.delete()
+    # Same defaults as RulePermission.save
+    if field_name == '':
+        field_name = codename
+    if view_param_pk == '':
+        view_param_pk = model_class._meta.pk.get_attname()
+
+    validate_rule(codename, field_name, model_class)
+
+    if codename in _registered_rules:
         sys.stderr.write('Careful rule %s being overwritten. Make sure its codename is not repeated in other rules.py files\n' % codename)
-        RulePermission.objects.create(codename=codename, field_name=field_name, content_type=ctype,
-                    view_param_pk=view_param_pk, description=description)
 
-    except RulePermission.DoesNotExist:
-        RulePermission.objects.create(codename=codename, field_name=field_name, content_type=ctype,
-                    view_param_pk=view_param_pk, description=description)
+    _registered_rules[codename] = {
+        'codename': codename,
+        'model_class': model_class,
+        'field_name': field_name,
+        'view_param_pk': view_param_pk,
+        'description': description,
+        'cache_timeout': cache_timeout,
+        'fingerprint': get_fingerprint(codename, model_class._meta.app_label, model_class._meta.object_name.lower(),
+                                        field_name, view_param_pk, description, cache_timeout),
+    }
+
+def get_registered_rules():
+    """
+    Returns the rule definitions registered so far, by codename
+    """
+    return _registered_rules
+
+def clear_registered_rules():
+    _registered_rules.clear()
+
+
+def sync(prune=False, using=None):
+    """
+    Syncs the registered rules into the database using, or the database
+    that the routers choose for writing rules, within a single transaction.
+    New rules are created, rules whose fingerprint changed are updated and, if
+    prune is True, rules that have not been registered are deleted. Returns the
+    lists of codenames (created, updated, deleted).
+    """
+    if using is None:
+        using = router.db_for_write(RulePermission)
+    created, updated, deleted = transaction.commit_on_success(using=using)(_sync)(prune, using)
+
+    # Signals were sent for the rules saved one by one and the deleted ones, but
+    # not for updates and bulk_create. They were sent before the commit, so the
+    # registry could have been reloaded with the old rules in the meantime.
+    if created or updated or deleted:
+        registry.invalidate()
+        registry.settle()
+    if updated or (created and hasattr(RulePermission.objects, 'bulk_create')):
+        bump_rules_version()
+    return created, updated, deleted
+
+def _sync(prune, using):
+    rules = RulePermission.objects.db_manager(using)
+    # ContentType ids can be different in every database
+    ctypes_manager = ContentType.objects.db_manager(using)
+
+    # Only fingerprints are needed to know which rules changed
+    existing = dict(rules.values_list('codename', 'fingerprint'))
+    changed = [definition for codename, definition in sorted(_registered_rules.items())
+                if existing.get(codename) != definition['fingerprint']]
+
+    # All ContentTypes are fetched at once, the missing ones are created
+    ctypes = {}
+    if changed:
+        app_labels = set(definition['model_class']._meta.app_label for definition in changed)
+        for ctype in ctypes_manager.filter(app_label__in=app_labels):
+            ctypes[(ctype.app_label, ctype.model)] = ctype
+
+    new_rules = []
+    updated = []
+    for definition in changed:
+        opts = definition['model_class']._meta
+        try:
+            ctype = ctypes[(opts.app_label, opts.object_name.lower())]
+        except KeyError:
+            ctype = ctypes_manager.get_for_model(definition['model_class'])
+
+        values = dict((field, definition[field]) for field in RULE_FIELDS)
+        values['content_type'] = ctype
+
+        if definition['codename'] not in existing:
+            new_rules.append(RulePermission(codename=definition['codename'], **values))
+        else:
+            rules.filter(pk=definition['codename']).update(**values)
+            updated.append(definition['codename'])
+
+    # Rules were already validated when registered
+    if hasattr(rules, 'bulk_create'):
+        rules.bulk_create(new_rules)
+    else:
+        for rule in new_rules:
+            rule.save_base(force_insert=True, using=using)
+
+    deleted = []
+    if prune:
+        deleted = sorted(codename for codename in existing if codename not in _registered_rules)
+        for start in range(0, len(deleted), DELETE_CHUNK_SIZE):
+            rules.filter(pk__in=deleted[start:start + DELETE_CHUNK_SIZE]).delete()
+
+    return [rule.codename for rule in new_rules], updated, deleted
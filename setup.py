@@ -30,6 +30,7 @@ setup(
     author_email='miguel.araujo.perez@gmail.com',
     url='http://github.com/maraujop/django-rules',
     license='BSD',
+    requires=['django (>=1.3)'],
     packages=find_packages(),
     zip_safe=False,
 )